@@ -0,0 +1,728 @@
+"""
+Benchmarks for the parsers in this repository, using synthetic files from deterministic generators so they run without the LU client.
+Results are printed as a table and can be appended to a JSON lines file to compare them across commits.
+"""
+import argparse
+import contextlib
+import datetime
+import hashlib
+import importlib.machinery
+import io
+import json
+import os
+import pickle
+import platform
+import random
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+import zlib
+
+import amf3
+import decompress_sd0
+import fdb_to_sqlite
+import find_packets
+import ldf
+import pkpacker
+import replicavalues
+import sqlite_to_fdb
+from bitstream import c_bit, c_float, c_int64, c_uint8, c_uint16, c_uint32, c_uint64, ReadStream, WriteStream
+from structparser import StructParser, StructSerializer
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+# fixed zip timestamp so generated captures are byte-identical between runs
+ZIP_DATE_TIME = 2010, 10, 26, 0, 0, 0
+WORDS = "brick", "minifig", "nexus", "maelstrom", "imagination", "paradox", "sentinel", "assembly", "venture", "explorer", "monument", "property", "rocket", "spider", "queen", "ninjago"
+
+def _load_pyw(name):
+	"""The GUI tools are .pyw scripts which can't be imported normally."""
+	return importlib.machinery.SourceFileLoader(name, os.path.join(SCRIPT_DIR, name+".pyw")).load_module()
+
+def _text(rng, size):
+	"""Compressible pseudo-text, similar to most LU assets."""
+	out = bytearray()
+	while len(out) < size:
+		out += rng.choice(WORDS).encode()+b" "
+	return bytes(out[:size])
+
+### generators
+
+FDB_COLUMNS = (1, "id"), (4, "name"), (3, "value"), (6, "big"), (5, "flag"), (8, "description")
+
+def generate_fdb(path, tables=4, rows=5000, seed=0):
+	"""Write a FDB database with the given number of tables, each with rows rows, some of them in linked bucket chains."""
+	rng = random.Random(seed)
+	fdb = bytearray(8+8*tables)
+	struct.pack_into("<ii", fdb, 0, tables, 8)
+
+	def put(data):
+		pos = len(fdb)
+		fdb.extend(data)
+		return pos
+
+	def put_string(str_):
+		return put(str_.encode("latin1")+b"\0")
+
+	for table in range(tables):
+		columns = b"".join(struct.pack("<ii", type_, put_string(name)) for type_, name in FDB_COLUMNS)
+		column_header = put(struct.pack("<iii", len(FDB_COLUMNS), put_string("Table%i" % table), put(columns)))
+
+		buckets = 1 << (rows-1).bit_length() if rows else 0
+		chains = [[] for _ in range(buckets)]
+		for _ in range(rows):
+			key = rng.randrange(buckets*2)
+			values = bytearray()
+			for type_, _ in FDB_COLUMNS:
+				if type_ != 1 and rng.random() < 0.05:
+					values += struct.pack("<ii", 0, 0)
+				elif type_ == 1:
+					values += struct.pack("<ii", 1, key)
+				elif type_ == 3:
+					values += struct.pack("<if", 3, rng.uniform(-1000, 1000))
+				elif type_ in (4, 8):
+					values += struct.pack("<ii", type_, put_string(" ".join(rng.choice(WORDS) for _ in range(rng.randrange(1, 8)))))
+				elif type_ == 5:
+					values += struct.pack("<i?xxx", 5, rng.random() < 0.5)
+				elif type_ == 6:
+					values += struct.pack("<ii", 6, put(struct.pack("<q", rng.getrandbits(63))))
+			chains[key % buckets].append(put(struct.pack("<ii", len(FDB_COLUMNS), put(values))))
+
+		bucket_pointers = []
+		for chain in chains:
+			node = -1
+			for row_info in reversed(chain):
+				node = put(struct.pack("<ii", row_info, node))
+			bucket_pointers.append(node)
+		# fdb_to_sqlite reads the bucket array lazily from the position after the row header, so it has to follow it directly
+		row_header = put(struct.pack("<ii%ii" % buckets, buckets, len(fdb)+8, *bucket_pointers))
+		struct.pack_into("<ii", fdb, 8+8*table, column_header, row_header)
+
+	with open(path, "wb") as file:
+		file.write(fdb)
+	return tables*rows
+
+def generate_sd0(path, size=8*1024*1024, seed=0):
+	"""Write a sd0 compressed file with size bytes of uncompressed data."""
+	data = _text(random.Random(seed), size)
+	with open(path, "wb") as file:
+		file.write(decompress_sd0.compress(data))
+	return size
+
+def generate_pk(path, files=500, file_size=16*1024, seed=0):
+	"""Write a .pk archive with the given number of files, mostly sd0 compressed."""
+	rng = random.Random(seed)
+	records = []
+	with open(path, "wb") as file:
+		file.write(b"ndpk\x01\xff\x00")
+		for index in range(files):
+			data = _text(rng, rng.randrange(file_size//2, file_size*3//2))
+			original_md5 = hashlib.md5(data).hexdigest()
+			is_compressed = index % 10 != 0
+			if is_compressed:
+				stored = decompress_sd0.compress(data)
+			else:
+				stored = data
+			records.append((zlib.crc32(str(index).encode()), -1, -1, len(data), original_md5.encode(), 0, len(stored), hashlib.md5(stored).hexdigest().encode(), 0, file.tell(), is_compressed, 0, 0, 0))
+			file.write(stored)
+			file.write(b"\xff\x00\x00\xdd\x00")
+		records_address = file.tell()
+		file.write(struct.pack("<I", len(records)))
+		for record in records:
+			file.write(struct.pack("<IiiI32sII32sII?BBB", *record))
+		file.write(struct.pack("<II", records_address, 0))
+	return files
+
+def _lif_part(type_, content, has_children):
+	return struct.pack(">HHQII", 1, type_, 20+len(content), 0 if has_children else 1, 0)+content
+
+def _lif_name(name):
+	return name.encode("utf-16-be")+b"\0\0"
+
+def generate_lif(path, dirs=10, files=100, file_size=4*1024, seed=0):
+	"""Write a .lif archive with dirs directories containing files files each."""
+	rng = random.Random(seed)
+	content = bytearray()
+	metadata = bytearray(struct.pack(">H", 1)+struct.pack(">I", 0)+_lif_name("")+struct.pack(">QI", 20, dirs))
+	for dir_index in range(dirs):
+		dir_content = bytearray()
+		metadata += struct.pack(">HI", 1, 7)+_lif_name("dir%i" % dir_index)+struct.pack(">QI", 20, files)
+		for file_index in range(files):
+			data = _text(rng, rng.randrange(file_size//2, file_size*3//2))
+			dir_content += _lif_part(4, data, False)
+			metadata += struct.pack(">HI", 2, 5)+_lif_name("file%i.g" % file_index)+struct.pack(">QQQQ", 20+len(data), rng.getrandbits(60), rng.getrandbits(60), rng.getrandbits(60))
+		content += _lif_part(3, dir_content, True)
+
+	root = _lif_part(2, struct.pack(">HI", 1, 0), False)+_lif_part(3, content, True)+_lif_part(5, metadata, False)
+	root = _lif_part(1, root, True)
+	with open(path, "wb") as file:
+		file.write(b"LIFF"+struct.pack(">QHI", 18+len(root), 1, 0)+root)
+	return dirs*files
+
+def _luz_wstring(str_):
+	return struct.pack("<B", len(str_))+str_.encode("utf-16-le")
+
+def _luz_string(str_):
+	return struct.pack("<B", len(str_))+str_.encode("latin1")
+
+def generate_lvl(path, objects=5000, seed=0):
+	"""Write a chunk based .lvl file with the given number of objects. The LOTs used are in range(1000, 1100)."""
+	rng = random.Random(seed)
+	lvl = bytearray()
+
+	def put_chunk(type_, data):
+		start = len(lvl)
+		lvl.extend(b"CHNK"+struct.pack("<IHHII", type_, 1, 1, 0, start+32))
+		lvl.extend(bytes(start+32-len(lvl)))
+		lvl.extend(data)
+		lvl.extend(bytes(-len(lvl) % 16))
+		struct.pack_into("<I", lvl, start+12, len(lvl)-start)
+
+	put_chunk(1000, struct.pack("<III", 38, 0, 0))
+	objects_data = bytearray(struct.pack("<I", objects))
+	for object_index in range(objects):
+		config = "name=0:object%i\ncustom_config_names=0:" % object_index
+		objects_data += struct.pack("<qIII3f4ff", object_index, rng.randrange(1000, 1100), 0, 0, *(rng.uniform(-500, 500) for _ in range(3)), 0, 0, 0, 1, 1)
+		objects_data += struct.pack("<I", len(config))+config.encode("utf-16-le")+struct.pack("<I", 0)
+	put_chunk(2001, objects_data)
+	with open(path, "wb") as file:
+		file.write(lvl)
+	return objects
+
+def generate_luz(path, objects=5000, paths=200, waypoints=20, seed=0):
+	"""Write a .luz file with one scene (written next to it as a .lvl with the given number of objects) and paths movement paths."""
+	rng = random.Random(seed)
+	lvl_filename = os.path.splitext(os.path.basename(path))[0]+".lvl"
+	generate_lvl(os.path.join(os.path.dirname(path), lvl_filename), objects, seed)
+	luz = bytearray(struct.pack("<III3f4fI", 41, 0, 1000, 0, 0, 0, 0, 0, 0, 1, 1))
+	luz += _luz_string(lvl_filename)+struct.pack("<Q", 0)+_luz_string("scene")+b"\x01\x00\x00"
+	luz += b"\x00"
+	luz += _luz_string("terrain.raw")+_luz_string("terrain")+_luz_string("")
+	luz += struct.pack("<I", 0) # scene transitions
+
+	paths_data = bytearray(struct.pack("<II", 1, paths))
+	for path_index in range(paths):
+		paths_data += struct.pack("<I", 18)+_luz_wstring("path%i" % path_index)+struct.pack("<III", 0, 0, 0)
+		paths_data += struct.pack("<I", waypoints)
+		for _ in range(waypoints):
+			paths_data += struct.pack("<3f", *(rng.uniform(-500, 500) for _ in range(3)))
+			paths_data += struct.pack("<I", 1)+_luz_wstring("delay")+_luz_wstring("0:%i" % rng.randrange(10))
+	luz += struct.pack("<I", len(paths_data))+paths_data
+	with open(path, "wb") as file:
+		file.write(luz)
+	return objects+paths*waypoints
+
+CAPTURE_PACKET_IDS = "24", "27", "53-05-00-0c", "53-04-00-05", "53-04-00-05", "53-05-00-0c", "53-05-00-16", "53-04-00-02"
+
+def generate_capture(path, packets=20000, seed=0, compression=zipfile.ZIP_DEFLATED):
+	"""Write a capture zip in our capture naming format with random payloads."""
+	rng = random.Random(seed)
+	with zipfile.ZipFile(path, "w", compression) as capture:
+		for index in range(packets):
+			id_ = rng.choice(CAPTURE_PACKET_IDS)
+			if id_.startswith("53"):
+				header = bytes.fromhex(id_.replace("-", ""))+bytes(4)
+			else:
+				header = bytes.fromhex(id_)
+			payload = header+bytes(rng.getrandbits(8) for _ in range(rng.randrange(16, 256)))
+			capture.writestr(zipfile.ZipInfo("%07i_[%s].bin" % (index, id_), ZIP_DATE_TIME), payload)
+	return packets
+
+# ControllablePhysics, Destructible, Character, Inventory, Skill, Render
+REPLICA_COMPONENTS = 1, 7, 4, 17, 9, 2
+REPLICA_LOT = 1000
+
+def _write_replica(stream, definition, rng, variables, overrides={}):
+	"""Write random values for the definition (a (parser, serializer) pair), retrying until they pass its asserts."""
+	parser, serializer = definition
+	values = {}
+	for _ in range(100):
+		data = serializer.serialize(replicavalues.random_values(rng, overrides, WORDS), variables)
+		try:
+			values = [structure.value for structure in parser.parse(ReadStream(data), variables)]
+			break
+		except (AssertionError, IndexError):
+			pass
+	serializer.serialize_to(stream, values, variables)
+
+def generate_replica_capture(path, db_path, objects=300, serializations=10, seed=0, compression=zipfile.ZIP_DEFLATED):
+	"""Write a capture with creations and serializations of objects with many components, and a database with their lot."""
+	captureviewer = _load_pyw("captureviewer")
+	definitions = os.path.join(SCRIPT_DIR, "packetdefinitions", "replica")
+	def read(path):
+		with open(os.path.join(definitions, path), encoding="utf-8") as file:
+			definition = file.read()
+		return StructParser(definition, replicavalues.TYPE_HANDLERS), StructSerializer(definition, replicavalues.TYPE_WRITERS)
+	creation_header = read("creation_header.structs")
+	serialization_header = read("serialization_header.structs")
+	components = []
+	for comp_type in sorted(REPLICA_COMPONENTS, key=captureviewer.comp_ids.index):
+		for name in captureviewer.component_name[comp_type]:
+			if name not in [name for name, _ in components]:
+				components.append((name, read(os.path.join("components", name+".structs"))))
+
+	if os.path.exists(db_path):
+		os.remove(db_path)
+	db = sqlite3.connect(db_path)
+	db.execute("create table Objects (id integer, name text)")
+	db.execute("create table ComponentsRegistry (id integer, component_type integer, component_id integer)")
+	db.execute("insert into Objects values (?, ?)", (REPLICA_LOT, "Benchmark Object"))
+	db.executemany("insert into ComponentsRegistry values (?, ?, 0)", [(REPLICA_LOT, comp_type) for comp_type in REPLICA_COMPONENTS])
+	db.commit()
+	db.close()
+
+	rng = random.Random(seed)
+	index = 0
+	with zipfile.ZipFile(path, "w", compression) as capture:
+		for network_id in range(objects):
+			for serialization in range(serializations+1):
+				stream = WriteStream()
+				if serialization == 0:
+					_write_replica(stream, creation_header, rng, {}, {**replicavalues.CREATION_HEADER_VALUES, "NetworkID": network_id, "objectID": 1152921504606846976+network_id, "LOT": REPLICA_LOT, "flag": False})
+					id_ = "24"
+				else:
+					stream.write(c_uint8(0x27))
+					stream.write(c_uint16(network_id))
+					id_ = "27"
+				variables = {"creation": serialization == 0}
+				_write_replica(stream, serialization_header, rng, variables)
+				for _, definition in components:
+					_write_replica(stream, definition, rng, variables)
+				capture.writestr(zipfile.ZipInfo("%07i_[%s].bin" % (index, id_), ZIP_DATE_TIME), bytes(stream))
+				index += 1
+	return index
+
+STRUCT_DEFINITION = """
+[u32] - some value
+flag=[bit] - flag
+	[float] - x
+	[float] - y
+	[float] - z
+[bit] - flag
+	[u8] - count
+		[s64] - object id
+if flag:
+	[u16-wstring] - name
+[u64] - some other value
+"""
+
+def generate_structs(path, structs=20000, seed=0):
+	"""Write binary data containing structs occurrences of STRUCT_DEFINITION, one after another."""
+	rng = random.Random(seed)
+	stream = WriteStream()
+	for _ in range(structs):
+		stream.write(c_uint32(rng.getrandbits(32)))
+		flag = rng.random() < 0.5
+		stream.write(c_bit(flag))
+		if flag:
+			for _ in range(3):
+				stream.write(c_float(rng.uniform(-500, 500)))
+		stream.write(c_bit(True))
+		count = rng.randrange(4)
+		stream.write(c_uint8(count))
+		for _ in range(count):
+			stream.write(c_int64(rng.getrandbits(60)))
+		if flag:
+			stream.write(rng.choice(WORDS), length_type=c_uint16)
+		stream.write(c_uint64(rng.getrandbits(64)))
+	with open(path, "wb") as file:
+		file.write(bytes(stream))
+	return structs
+
+def generate_amf3(path, items=20000, seed=0):
+	"""Write an AMF3 array with items entries."""
+	rng = random.Random(seed)
+	array = {}
+	for index in range(items):
+		kind = index % 4
+		if kind == 0:
+			array["key%i" % index] = rng.uniform(-1000, 1000)
+		elif kind == 1:
+			array["key%i" % index] = rng.choice(WORDS)
+		elif kind == 2:
+			array["key%i" % index] = rng.random() < 0.5
+		else:
+			array["key%i" % index] = {"nested": rng.uniform(0, 1), "name": rng.choice(WORDS)}
+	stream = WriteStream()
+	amf3.write(array, stream)
+	with open(path, "wb") as file:
+		file.write(bytes(stream))
+	return items
+
+def generate_ldf(path, items=20000, seed=0):
+	"""Write binary LDF data with items keys of all supported types."""
+	rng = random.Random(seed)
+	ldf_data = bytearray(struct.pack("<I", items))
+	for index in range(items):
+		key = ("key%i" % index).encode("utf-16-le")
+		ldf_data += struct.pack("<B", len(key))+key
+		data_type = (0, 1, 3, 5, 7, 8, 9, 13)[index % 8]
+		ldf_data += struct.pack("<B", data_type)
+		if data_type == 0:
+			value = rng.choice(WORDS)
+			ldf_data += struct.pack("<I", len(value))+value.encode("utf-16-le")
+		elif data_type == 1:
+			ldf_data += struct.pack("<i", rng.randrange(-2**31, 2**31))
+		elif data_type == 3:
+			ldf_data += struct.pack("<f", rng.uniform(-1000, 1000))
+		elif data_type == 5:
+			ldf_data += struct.pack("<I", rng.getrandbits(32))
+		elif data_type == 7:
+			ldf_data += struct.pack("<?", rng.random() < 0.5)
+		elif data_type in (8, 9):
+			ldf_data += struct.pack("<q", rng.getrandbits(63))
+		elif data_type == 13:
+			value = rng.choice(WORDS).encode()
+			ldf_data += struct.pack("<I", len(value))+value
+	with open(path, "wb") as file:
+		file.write(ldf_data)
+	return items
+
+### runners
+# Each runner gets the data directory and the scale and returns (setup function, run function, unit).
+# The setup function generates the input and returns the number of units processed by one run, the run function gets the generated path.
+
+class _Stub:
+	"""Stands in for the Tk tree of the viewers."""
+	def __init__(self):
+		self.count = 0
+
+	def insert(self, *args, **kwargs):
+		self.count += 1
+		return str(self.count)
+
+class _Tree(_Stub):
+	"""Keeps the inserted items, for viewers that read them back."""
+	def __init__(self):
+		super().__init__()
+		self.items = {}
+
+	def insert(self, parent, index, **kwargs):
+		item = super().insert()
+		self.items[item] = kwargs
+		return item
+
+	def item(self, item, option):
+		return self.items[item][option]
+
+class _Var:
+	"""Stands in for the Tk variables of the viewer options."""
+	def __init__(self, value):
+		self.value = value
+
+	def get(self):
+		return self.value
+
+def bench_fdb_to_sqlite(data_dir, scale):
+	path = os.path.join(data_dir, "bench.fdb")
+	out_path = os.path.join(data_dir, "bench.sqlite")
+	def setup():
+		generate_fdb(path, rows=int(5000*scale))
+		return os.path.getsize(path)
+	def run():
+		with contextlib.redirect_stdout(io.StringIO()):
+			fdb_to_sqlite.convert(path, out_path, add_link_info=True)
+	return setup, run, "bytes"
+
+def bench_sqlite_to_fdb(data_dir, scale):
+	fdb_path = os.path.join(data_dir, "bench_in.fdb")
+	sqlite_path = os.path.join(data_dir, "bench_in.sqlite")
+	out_path = os.path.join(data_dir, "bench_out.fdb")
+	def setup():
+		generate_fdb(fdb_path, rows=int(5000*scale))
+		with contextlib.redirect_stdout(io.StringIO()):
+			fdb_to_sqlite.convert(fdb_path, sqlite_path, add_link_info=True)
+		return os.path.getsize(fdb_path)
+	def run():
+		with contextlib.redirect_stdout(io.StringIO()):
+			sqlite_to_fdb.convert(sqlite_path, out_path)
+	return setup, run, "bytes"
+
+def bench_decompress_sd0(data_dir, scale):
+	path = os.path.join(data_dir, "bench.sd0")
+	data = []
+	def setup():
+		size = generate_sd0(path, int(8*1024*1024*scale))
+		with open(path, "rb") as file:
+			data[:] = file.read(),
+		return size
+	def run():
+		decompress_sd0.decompress(data[0])
+	return setup, run, "bytes"
+
+def bench_pk(data_dir, scale):
+	path = os.path.join(data_dir, "bench.pk")
+	pkextractor = _load_pyw("pkextractor")
+	def setup():
+		return generate_pk(path, int(500*scale))
+	def run():
+		extractor = pkextractor.PKExtractor.__new__(pkextractor.PKExtractor) # without the GUI
+		extractor.records = {}
+		extractor._load_pk(path, {})
+	return setup, run, "records"
+
+def bench_pkpacker(data_dir, scale):
+	root = os.path.join(data_dir, "bench_pack")
+	path = os.path.join(data_dir, "bench_packed.pk")
+	def setup():
+		rng = random.Random(0)
+		size = 0
+		for index in range(int(500*scale)):
+			name = os.path.join(root, "dir%i" % (index % 10), "file%i.txt" % index)
+			os.makedirs(os.path.dirname(name), exist_ok=True)
+			data = _text(rng, rng.randrange(8*1024, 24*1024))
+			with open(name, "wb") as file:
+				file.write(data)
+			size += len(data)
+		return size
+	def run():
+		pkpacker.pack(root, path)
+	return setup, run, "bytes"
+
+def bench_lif(data_dir, scale):
+	path = os.path.join(data_dir, "bench.lif")
+	lifextractor = _load_pyw("lifextractor")
+	def setup():
+		return generate_lif(path, files=int(100*scale))
+	def run():
+		extractor = lifextractor.LIFExtractor.__new__(lifextractor.LIFExtractor) # without the GUI
+		extractor.records = {}
+		extractor.current_file_data_offset = 84
+		with open(path, "rb") as file, contextlib.redirect_stdout(io.StringIO()):
+			file.seek(18)
+			extractor._read_part(file, 0)
+	return setup, run, "files"
+
+def bench_luz(data_dir, scale):
+	path = os.path.join(data_dir, "bench.luz")
+	luzviewer = _load_pyw("luzviewer")
+	db = sqlite3.connect(":memory:")
+	db.execute("create table Objects (id int, name text)")
+	db.executemany("insert into Objects values (?, ?)", ((lot, "object %i" % lot) for lot in range(1000, 1100)))
+	def setup():
+		return generate_luz(path, int(5000*scale), int(200*scale))
+	def run():
+		viewer = luzviewer.LUZViewer.__new__(luzviewer.LUZViewer) # without the GUI
+		viewer.tree = _Stub()
+		viewer.db = db
+		viewer.set_superbar = lambda maximum: None
+		viewer.step_superbar = lambda arg, desc="": range(arg)
+		with contextlib.redirect_stdout(io.StringIO()):
+			viewer.load(path)
+	return setup, run, "items"
+
+def bench_structparser(data_dir, scale):
+	path = os.path.join(data_dir, "bench.structs.bin")
+	parser = StructParser(STRUCT_DEFINITION)
+	data = []
+	def setup():
+		structs = generate_structs(path, int(20000*scale))
+		with open(path, "rb") as file:
+			data[:] = file.read(), structs
+		return structs
+	def run():
+		stream = ReadStream(data[0])
+		for _ in range(data[1]):
+			for _ in parser.parse(stream):
+				pass
+	return setup, run, "structs"
+
+def bench_amf3(data_dir, scale):
+	path = os.path.join(data_dir, "bench.amf3")
+	data = []
+	def setup():
+		items = generate_amf3(path, int(20000*scale))
+		with open(path, "rb") as file:
+			data[:] = file.read(),
+		return items
+	def run():
+		amf3.read(ReadStream(data[0]))
+	return setup, run, "items"
+
+def bench_ldf(data_dir, scale):
+	path = os.path.join(data_dir, "bench.ldf")
+	data = []
+	def setup():
+		items = generate_ldf(path, int(20000*scale))
+		with open(path, "rb") as file:
+			data[:] = file.read(),
+		return items
+	def run():
+		ldf.from_ldf(ReadStream(data[0]))
+	return setup, run, "items"
+
+def bench_find_packets_index(data_dir, scale):
+	capture_dir = os.path.join(data_dir, "captures")
+	index_path = os.path.join(data_dir, "bench_index.sqlite")
+	def setup():
+		os.makedirs(capture_dir, exist_ok=True)
+		return generate_capture(os.path.join(capture_dir, "bench.zip"), int(20000*scale))
+	def run():
+		if os.path.exists(index_path):
+			os.remove(index_path)
+		with find_packets.PacketIndex(index_path) as index:
+			index.update(capture_dir)
+	return setup, run, "packets"
+
+def bench_find_packets_search(data_dir, scale, compression=zipfile.ZIP_DEFLATED):
+	capture_dir = os.path.join(data_dir, "captures_%i" % compression)
+	packets = []
+	def setup():
+		os.makedirs(capture_dir, exist_ok=True)
+		count = generate_capture(os.path.join(capture_dir, "bench.zip"), int(20000*scale), compression=compression)
+		packets[:] = find_packets.iter_packets(capture_dir)
+		return count
+	def run():
+		for _ in find_packets.search_packets(packets, find_packets.int_matcher("s64", 1152921504606846976)):
+			pass
+	return setup, run, "packets"
+
+def bench_find_packets_search_stored(data_dir, scale):
+	"""Uncompressed captures are searched in place in the mapped zip."""
+	return bench_find_packets_search(data_dir, scale, zipfile.ZIP_STORED)
+
+def bench_captureviewer(data_dir, scale, compression=zipfile.ZIP_DEFLATED):
+	path = os.path.join(data_dir, "bench_replica_%i.zip" % compression)
+	db_path = os.path.join(data_dir, "bench_cdclient.sqlite")
+	captureviewer = _load_pyw("captureviewer")
+	def setup():
+		return generate_replica_capture(path, db_path, int(300*scale), compression=compression)
+	def run():
+		viewer = captureviewer.CaptureViewer.__new__(captureviewer.CaptureViewer) # without the GUI
+		viewer.tree = _Tree()
+		viewer.db_path = db_path
+		viewer.db = sqlite3.connect(db_path)
+		viewer.definition_hashes = {}
+		viewer._create_parsers()
+		with open(os.path.join(SCRIPT_DIR, "packetdefinitions", "gm"), "rb") as file:
+			viewer.gamemsgs = pickle.loads(zlib.decompress(file.read()))
+		viewer.objects = []
+		viewer.lot_data = {}
+		viewer.lot_retries = {}
+		viewer.details = {}
+		viewer._object_indices = {}
+		viewer._cache_rows = None
+		viewer._stage_metrics = None
+		for option in ("parse_creations", "parse_serializations", "parse_game_messages", "parse_normal_packets", "retry_with_script_component", "retry_with_trigger_component", "retry_with_phantom_component"):
+			setattr(viewer, option, _Var(True))
+		viewer.use_cache = _Var(False)
+		viewer.profile_parsers = _Var(False)
+		viewer.set_superbar = lambda maximum: None
+		viewer.step_superbar = lambda arg, desc="": range(arg)
+		with contextlib.redirect_stdout(io.StringIO()):
+			viewer.load([path])
+		viewer.db.close()
+	return setup, run, "packets"
+
+def bench_captureviewer_stored(data_dir, scale):
+	return bench_captureviewer(data_dir, scale, zipfile.ZIP_STORED)
+
+BENCHMARKS = {}
+BENCHMARKS["fdb_to_sqlite"] = bench_fdb_to_sqlite
+BENCHMARKS["sqlite_to_fdb"] = bench_sqlite_to_fdb
+BENCHMARKS["decompress_sd0"] = bench_decompress_sd0
+BENCHMARKS["pk"] = bench_pk
+BENCHMARKS["pkpacker"] = bench_pkpacker
+BENCHMARKS["lif"] = bench_lif
+BENCHMARKS["luz"] = bench_luz
+BENCHMARKS["structparser"] = bench_structparser
+BENCHMARKS["amf3"] = bench_amf3
+BENCHMARKS["ldf"] = bench_ldf
+BENCHMARKS["find_packets_index"] = bench_find_packets_index
+BENCHMARKS["find_packets_search"] = bench_find_packets_search
+BENCHMARKS["find_packets_search_stored"] = bench_find_packets_search_stored
+BENCHMARKS["captureviewer"] = bench_captureviewer
+BENCHMARKS["captureviewer_stored"] = bench_captureviewer_stored
+
+def _memory_status(field):
+	"""A memory field (like VmRSS) of /proc/self/status in bytes, None where it isn't available (it's Linux only)."""
+	try:
+		with open("/proc/self/status") as file:
+			for line in file:
+				if line.startswith(field+":"):
+					return int(line.split()[1])*1024
+	except OSError:
+		pass
+	return None
+
+def _reset_peak_rss():
+	"""Reset the peak resident memory (VmHWM) to the current one and return it, None if that isn't supported."""
+	try:
+		with open("/proc/self/clear_refs", "w") as file:
+			file.write("5")
+	except OSError:
+		return None
+	return _memory_status("VmRSS")
+
+def run_benchmark(name, data_dir, scale=1, repeat=3):
+	"""
+	Run a benchmark from BENCHMARKS.
+	Returns:
+		A dict with the benchmark name, the processed amount and unit, the best time of repeat runs in seconds, the throughput per second, the peak memory of the Python allocations during a separate traced run in bytes and the growth of the resident memory during the first run in bytes (None if it can't be measured, it's Linux only).
+	"""
+	setup, run, unit = BENCHMARKS[name](data_dir, scale)
+	amount = setup()
+	times = []
+	peak_rss = None
+	# later runs reuse memory the allocator kept from the first one, so only that one is measured
+	rss_before = _reset_peak_rss()
+	for _ in range(repeat):
+		start = time.perf_counter()
+		run()
+		times.append(time.perf_counter() - start)
+		if peak_rss is None and rss_before is not None:
+			peak_rss = _memory_status("VmHWM") - rss_before
+	# tracing slows everything down, so measure memory separately
+	tracemalloc.start()
+	run()
+	_, peak_memory = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	seconds = min(times)
+	return {"name": name, "amount": amount, "unit": unit, "seconds": seconds, "throughput": amount/seconds, "peak_memory": peak_memory, "peak_rss": peak_rss}
+
+def _commit():
+	try:
+		return subprocess.run(["git", "rev-parse", "HEAD"], cwd=SCRIPT_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+if __name__ == "__main__":
+	argparser = argparse.ArgumentParser(description=__doc__)
+	argparser.add_argument("benchmarks", nargs="*", help="benchmarks to run, all if not given. Available: "+", ".join(BENCHMARKS))
+	argparser.add_argument("--scale", type=float, default=1, help="multiplier for the size of the generated files")
+	argparser.add_argument("--repeat", type=int, default=3, help="number of timed runs, the best is reported")
+	argparser.add_argument("--data_dir", help="directory for the generated files, a temporary directory if not given")
+	argparser.add_argument("--out", help="JSON lines file to append the results to")
+	args = argparser.parse_args()
+
+	names = args.benchmarks or list(BENCHMARKS)
+	for name in names:
+		if name not in BENCHMARKS:
+			argparser.error("unknown benchmark "+name)
+
+	with tempfile.TemporaryDirectory() as temp_dir:
+		data_dir = args.data_dir or temp_dir
+		os.makedirs(data_dir, exist_ok=True)
+		results = []
+		print("%-26s %12s %10s %16s %12s %12s" % ("benchmark", "amount", "time (s)", "throughput (/s)", "peak memory", "peak RSS"))
+		for name in names:
+			result = run_benchmark(name, data_dir, args.scale, args.repeat)
+			results.append(result)
+			if result["unit"] == "bytes":
+				throughput = "%.2f MB" % (result["throughput"]/1024/1024)
+			else:
+				throughput = "%.0f %s" % (result["throughput"], result["unit"])
+			if result["peak_rss"] is None:
+				peak_rss = "-"
+			else:
+				peak_rss = "%.2f MB" % (result["peak_rss"]/1024/1024)
+			print("%-26s %12i %10.3f %16s %9.2f MB %12s" % (name, result["amount"], result["seconds"], throughput, result["peak_memory"]/1024/1024, peak_rss))
+
+	if args.out is not None:
+		record = {"commit": _commit(), "time": datetime.datetime.now().isoformat(), "python": platform.python_version(), "platform": platform.platform(), "scale": args.scale, "results": results}
+		with open(args.out, "a") as file:
+			file.write(json.dumps(record)+"\n")
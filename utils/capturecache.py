@@ -0,0 +1,99 @@
+"""Module for storing the parse results of a capture in a SQLite file next to it, so reopening the capture doesn't need to parse it again."""
+import hashlib
+import json
+import sqlite3
+
+CACHE_EXTENSION = ".parsecache"
+# increase when changing the tables, caches with a different version are cleared
+SCHEMA_VERSION = 4
+
+def file_hash(path):
+	hash_ = hashlib.sha1()
+	with open(path, "rb") as file:
+		for chunk in iter(lambda: file.read(1024*1024), b""):
+			hash_.update(chunk)
+	return hash_.hexdigest()
+
+def key(*parts):
+	"""Combine the parts (bytes, or anything with a stable str(), like other keys) into a key, a change in any part changes the key."""
+	hash_ = hashlib.sha1()
+	for part in parts:
+		if not isinstance(part, bytes):
+			part = str(part).encode()
+		hash_.update(len(part).to_bytes(8, "little"))
+		hash_.update(part)
+	return hash_.hexdigest()
+
+class CaptureCache:
+	"""
+	Parse results of one capture, grouped by kind (e.g. creations, or normal packets of one id).
+	Each kind is stored with a key of everything its results depend on (definitions, options, results of other kinds). Results of a kind are only used if its key is unchanged, so e.g. a changed definition only invalidates the kinds using it.
+	The results of a packet are a list of rows (parent, obj, text, values, tags, details), one for each tree entry it created:
+	parent: index of the object in the viewer's object list whose entry is the parent, or None for top level entries
+	obj: fields of the object created along with the entry, or None
+	details: JSON compatible data of the parse output shown for the entry, or None
+	The cache file comes with the capture when it's passed around, so it only stores plain data (JSON and text) that is safe to load from untrusted files, no pickles.
+	"""
+	def __init__(self, capture_path):
+		"""Raises sqlite3.Error if the cache file can't be opened or written, e.g. next to a capture in a read-only location."""
+		self.db = sqlite3.connect(capture_path+CACHE_EXTENSION)
+		try:
+			self._open(capture_path)
+		except:
+			self.db.close()
+			raise
+
+	def _open(self, capture_path):
+		if self.db.execute("pragma user_version").fetchone()[0] != SCHEMA_VERSION:
+			for table in ("capture", "kinds", "packets"):
+				self.db.execute("drop table if exists "+table)
+		# always written, so that an unwritable file fails here instead of on the first write while parsing
+		self.db.execute("pragma user_version = %i" % SCHEMA_VERSION)
+		self.db.execute("create table if not exists capture (hash text)")
+		self.db.execute("create table if not exists kinds (kind text primary key, key text)")
+		self.db.execute("create table if not exists packets (kind text, packet text, parent integer, obj text, text text, vals text, tags text, details text)")
+		self.db.execute("create index if not exists packets_kind on packets (kind)")
+
+		self.capture_hash = file_hash(capture_path)
+		row = self.db.execute("select hash from capture").fetchone()
+		if row is None or row[0] != self.capture_hash:
+			self.db.execute("delete from capture")
+			self.db.execute("delete from kinds")
+			self.db.execute("delete from packets")
+			self.db.execute("insert into capture values (?)", (self.capture_hash,))
+		self.keys = dict(self.db.execute("select kind, key from kinds"))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.close(commit=exc_type is None)
+
+	def close(self, commit=True):
+		if commit:
+			self.db.commit()
+		self.db.close()
+
+	def is_valid(self, kind, key):
+		return self.keys.get(kind) == key
+
+	def results(self, kind):
+		"""Cached rows of each packet of the kind, by packet name."""
+		results = {}
+		for packet, parent, obj, text, values, tags, details in self.db.execute("select packet, parent, obj, text, vals, tags, details from packets where kind == ? order by rowid", (kind,)):
+			rows = results.setdefault(packet, [])
+			if text is not None: # packets that didn't create entries are stored with a placeholder row
+				rows.append((parent, json.loads(obj) if obj is not None else None, text, tuple(json.loads(values)), json.loads(tags), json.loads(details) if details is not None else None))
+		return results
+
+	def reset(self, kind, key):
+		"""Drop the results of the kind, results added afterwards are stored with the new key."""
+		self.db.execute("delete from packets where kind == ?", (kind,))
+		self.db.execute("insert or replace into kinds values (?, ?)", (kind, key))
+		self.keys[kind] = key
+
+	def add(self, kind, packet, rows):
+		if not rows:
+			self.db.execute("insert into packets (kind, packet) values (?, ?)", (kind, packet))
+			return
+		self.db.executemany("insert into packets values (?, ?, ?, ?, ?, ?, ?, ?)", [(kind, packet, parent, json.dumps(obj) if obj is not None else None, text, json.dumps(values), json.dumps(tags), json.dumps(details) if details is not None else None) for parent, obj, text, values, tags, details in rows])
@@ -1,23 +1,28 @@
+import ast
 import configparser
 import glob
+import heapq
+import json
 import os.path
 import pickle
 import pprint
 import struct
 import sqlite3
 import sys
+import time
 import tkinter.filedialog as filedialog
 import tkinter.messagebox as messagebox
-import zipfile
 import zlib
 from collections import OrderedDict
 from tkinter import BooleanVar, END, Menu
 
 import amf3
+import capturecache
 import viewer
 import ldf
 from bitstream import c_bit, c_bool, c_float, c_int, c_int64, c_ubyte, c_uint, c_uint64, c_ushort, ReadStream
-from structparser import StructParser
+from structparser import format_profiles, StructParser, write_collapsed_stacks
+from zipmembers import ZipMembers
 
 component_name = OrderedDict()
 component_name[108] = "Component 108",
@@ -69,9 +74,24 @@ component_name[113] = None
 component_name[114] = None
 comp_ids = list(component_name.keys())
 
+STAGES = "creations", "serializations", "game_messages", "normal_packets"
+ERROR_TAGS = "assertfail", "readerror", "error"
+SLOWEST_PACKETS = 20
+# part of all parse cache keys, increase when changing how packets are parsed or displayed
+CACHE_VERSION = 2
+
+# (level, description, unexpected) keys of parse output records, shared between all outputs
+record_keys = {}
+
 class ParserOutput:
+	"""
+	Parse result of a packet, kept as records and only rendered to text when it's shown.
+	To keep them small, the records are stored flat as key, value pairs, with the key a shared (level, description, unexpected) tuple, or None for other lines like headings and errors, which are the value.
+	"""
+	__slots__ = "records", "tags"
+
 	def __init__(self):
-		self.text = ""
+		self.records = []
 		self.tags = []
 
 	def __enter__(self):
@@ -90,15 +110,192 @@ class ParserOutput:
 				self.tags.append("error")
 				import traceback
 				traceback.print_tb(tb)
-			self.text = exc_name+" "+str(exc_type.__name__)+": "+str(exc_value)+"\n"+self.text
+			self.add_line(exc_name+" "+str(exc_type.__name__)+": "+str(exc_value), first=True)
 			return True
 
+	def add_line(self, line, first=False):
+		if first:
+			self.records[0:0] = None, line
+		else:
+			self.records += None, line
+
 	def append(self, structs):
+		records = self.records
 		for level, description, value, unexpected in structs:
+			key = level, description, unexpected
+			records.append(record_keys.setdefault(key, key))
+			records.append(value)
 			if unexpected:
-				self.text += "UNEXPECTED: "
 				self.tags.append("unexpected")
-			self.text += "\t"*level+description+": "+str(value)+"\n"
+
+	def render(self):
+		lines = []
+		records = self.records
+		for index in range(0, len(records), 2):
+			key, value = records[index], records[index+1]
+			if key is None:
+				lines.append(value+"\n")
+			else:
+				level, description, unexpected = key
+				if unexpected:
+					lines.append("UNEXPECTED: ")
+				lines.append("\t"*level+description+": "+str(value)+"\n")
+		return "".join(lines)
+
+	def matches(self, query):
+		"""Whether a line of the rendered text contains the (lowercase) query, checked without rendering all of it."""
+		records = self.records
+		for index in range(0, len(records), 2):
+			key, value = records[index], records[index+1]
+			if key is None:
+				line = value
+			else:
+				line = key[1]+": "+str(value)
+			if query in line.lower():
+				return True
+		return False
+
+	def cache_data(self):
+		"""JSON compatible data for the parse cache, with the values converted to strings, see details_from_cache."""
+		data = []
+		records = self.records
+		for index in range(0, len(records), 2):
+			key, value = records[index], records[index+1]
+			if key is None:
+				data.append([value])
+			else:
+				level, description, unexpected = key
+				data.append([level, description, str(value), unexpected])
+		return {"records": data}
+
+	@classmethod
+	def from_cache_data(cls, data):
+		output = cls()
+		records = output.records
+		for record in data["records"]:
+			if len(record) == 1:
+				records += None, record[0]
+			else:
+				level, description, value, unexpected = record
+				key = level, description, unexpected
+				records.append(record_keys.setdefault(key, key))
+				records.append(value)
+		return output
+
+def _pformat_repr(text):
+	"""Pretty format a value stored as its repr, values that aren't literals are shown as they are."""
+	try:
+		return pprint.pformat(ast.literal_eval(text))
+	except (ValueError, TypeError, SyntaxError, RecursionError):
+		return text
+
+class GameMessageOutput:
+	"""
+	Parameter values of a game message, only formatted when it's shown. message is shown before them, e.g. for errors.
+	Outputs loaded from the parse cache have the values as strings (repr for pretty outputs), which are formatted like the values.
+	"""
+	__slots__ = "param_values", "message", "pretty", "from_cache"
+
+	def __init__(self, param_values, message=None, pretty=True):
+		self.param_values = param_values
+		self.message = message
+		self.pretty = pretty
+		self.from_cache = False
+
+	def render(self):
+		if not self.pretty:
+			format_value = str
+		elif self.from_cache:
+			format_value = _pformat_repr
+		else:
+			format_value = pprint.pformat
+		text = "\n".join(["%s = %s" % (name, format_value(value)) for name, value in self.param_values.items()])
+		if self.message is not None:
+			text = self.message+"\n"+text
+		return text
+
+	def matches(self, query):
+		"""Whether the (lowercase) query is in the message or a parameter, checked with the unformatted values, so without pretty printing them."""
+		if self.message is not None and query in self.message.lower():
+			return True
+		if self.pretty and not self.from_cache:
+			format_value = repr
+		else:
+			format_value = str
+		return any(query in ("%s = %s" % (name, format_value(value))).lower() for name, value in self.param_values.items())
+
+	def cache_data(self):
+		"""JSON compatible data for the parse cache, with the values converted to strings, see details_from_cache."""
+		if self.pretty:
+			values = [[name, repr(value)] for name, value in self.param_values.items()]
+		else:
+			values = [[name, str(value)] for name, value in self.param_values.items()]
+		return {"param_values": values, "message": self.message, "pretty": self.pretty}
+
+	@classmethod
+	def from_cache_data(cls, data):
+		output = cls(OrderedDict(data["param_values"]), data["message"], data["pretty"])
+		output.from_cache = True
+		return output
+
+def details_from_cache(data):
+	"""Recreate the ParserOutput or GameMessageOutput of the cache_data stored in the parse cache."""
+	if "records" in data:
+		return ParserOutput.from_cache_data(data)
+	return GameMessageOutput.from_cache_data(data)
+
+class StageMetrics:
+	"""
+	Timings (in seconds) and counters of one parsing stage of a capture.
+	zip_time is reading the packet's raw (possibly compressed) data from the zip, decode_time is decompressing it and setting up the packet stream, parse_time is parsing excluding insert_time, the time spent inserting into the tree.
+	retry_time is the time spent in parsing attempts that failed and were retried with additional components.
+	cached is the number of packets loaded from the parse cache instead of being parsed, they are only counted in time and insert_time.
+	"""
+	def __init__(self):
+		self.packets = 0
+		self.cached = 0
+		self.time = 0
+		self.zip_time = 0
+		self.decode_time = 0
+		self.parse_time = 0
+		self.insert_time = 0
+		self.errors = 0
+		self.retries = 0
+		self.retry_time = 0
+
+class CaptureMetrics:
+	"""Load metrics of one capture: StageMetrics for each of STAGES and the slowest packets."""
+	def __init__(self, capture):
+		self.capture = capture
+		self.stages = OrderedDict((stage, StageMetrics()) for stage in STAGES)
+		self.slowest = [] # heap of (seconds, stage, packet name)
+
+	def add_packet(self, seconds, stage, packet_name):
+		if len(self.slowest) < SLOWEST_PACKETS:
+			heapq.heappush(self.slowest, (seconds, stage, packet_name))
+		else:
+			heapq.heappushpop(self.slowest, (seconds, stage, packet_name))
+
+	def to_dict(self):
+		return OrderedDict((
+			("capture", self.capture),
+			("stages", OrderedDict((stage, vars(metrics)) for stage, metrics in self.stages.items())),
+			("slowest", [OrderedDict((("seconds", seconds), ("stage", stage), ("packet", packet_name))) for seconds, stage, packet_name in sorted(self.slowest, reverse=True)]),
+		))
+
+	def summary(self):
+		out = self.capture+"\n"
+		out += "%-15s %8s %8s %10s %10s %10s %10s %10s %10s %7s %8s %10s\n" % ("stage", "packets", "cached", "total (s)", "read (s)", "decode (s)", "parse (s)", "insert (s)", "packets/s", "errors", "retries", "retry (s)")
+		for stage, metrics in self.stages.items():
+			if metrics.time:
+				packets_per_second = metrics.packets/metrics.time
+			else:
+				packets_per_second = 0
+			out += "%-15s %8i %8i %10.3f %10.3f %10.3f %10.3f %10.3f %10.0f %7i %8i %10.3f\n" % (stage, metrics.packets, metrics.cached, metrics.time, metrics.zip_time, metrics.decode_time, metrics.parse_time, metrics.insert_time, packets_per_second, metrics.errors, metrics.retries, metrics.retry_time)
+		out += "Slowest packets:\n"
+		for seconds, stage, packet_name in sorted(self.slowest, reverse=True):
+			out += "%9.3f ms %s (%s)\n" % (seconds*1000, packet_name, stage)
+		return out
 
 class CaptureObject:
 	def __init__(self, network_id=None, object_id=None, lot=None):
@@ -111,19 +308,31 @@ class CaptureViewer(viewer.Viewer):
 	def init(self):
 		config = configparser.ConfigParser()
 		config.read("captureviewer.ini")
+		self.db_path = config["paths"]["db_path"]
 		try:
-			self.db = sqlite3.connect(config["paths"]["db_path"])
+			self.db = sqlite3.connect(self.db_path)
 		except:
 			messagebox.showerror("Can not open database", "Make sure db_path in the INI is set correctly.")
 			sys.exit()
 
+		self.definition_hashes = {}
 		self._create_parsers()
 
 		with open("packetdefinitions/gm", "rb") as file:
-			self.gamemsgs = pickle.loads(zlib.decompress(file.read()))
+			gm = file.read()
+		self.gamemsgs = pickle.loads(zlib.decompress(gm))
+		self.definition_hashes["gm"] = capturecache.key(gm)
 
 		self.objects = []
+		self.details = {}
 		self.lot_data = {}
+		self.lot_retries = {}
+		self._object_indices = {}
+		self._cache_rows = None
+		self._previous_captures = ()
+		self.metrics = []
+		self.profiles = []
+		self._stage_metrics = None
 		self.parse_creations = BooleanVar(value=config["parse"]["creations"])
 		self.parse_serializations = BooleanVar(value=config["parse"]["serializations"])
 		self.parse_game_messages = BooleanVar(value=config["parse"]["game_messages"])
@@ -131,6 +340,8 @@ class CaptureViewer(viewer.Viewer):
 		self.retry_with_script_component = BooleanVar(value=config["parse"]["retry_with_script_component"])
 		self.retry_with_trigger_component = BooleanVar(value=config["parse"]["retry_with_trigger_component"])
 		self.retry_with_phantom_component = BooleanVar(value=config["parse"]["retry_with_phantom_component"])
+		self.use_cache = BooleanVar(value=config["parse"].getboolean("cache", True))
+		self.profile_parsers = BooleanVar(value=config["parse"].getboolean("profile", False))
 
 	def _create_parsers(self):
 		type_handlers = {}
@@ -138,24 +349,37 @@ class CaptureViewer(viewer.Viewer):
 		type_handlers["lot"] = self._lot_handler
 		type_handlers["compressed_ldf"] = self._compressed_ldf_handler
 
-		with open(os.path.dirname(os.path.realpath(__file__))+"/packetdefinitions/replica/creation_header.structs", encoding="utf-8") as file:
-			self.creation_header_parser = StructParser(file.read(), type_handlers)
-		with open(os.path.dirname(os.path.realpath(__file__))+"/packetdefinitions/replica/serialization_header.structs", encoding="utf-8") as file:
-			self.serialization_header_parser = StructParser(file.read(), type_handlers)
+		self.creation_header_parser = StructParser(self._read_definition("replica/creation_header.structs"), type_handlers)
+		self.serialization_header_parser = StructParser(self._read_definition("replica/serialization_header.structs"), type_handlers)
 
 		self.comp_parser = {}
 		for comp_id, indices in component_name.items():
 			if indices is not None:
 				self.comp_parser[comp_id] = []
 				for index in indices:
-					with open(os.path.dirname(os.path.realpath(__file__))+"/packetdefinitions/replica/components/"+index+".structs") as file:
-						self.comp_parser[comp_id].append(StructParser(file.read(), type_handlers))
+					self.comp_parser[comp_id].append(StructParser(self._read_definition("replica/components/"+index+".structs"), type_handlers))
 
 
 		self.norm_parser = {}
 		for path in glob.glob(os.path.dirname(os.path.realpath(__file__))+"/packetdefinitions/*.structs"):
-			with open(path, encoding="utf-8") as file:
-				self.norm_parser[os.path.splitext(os.path.basename(path))] = StructParser(file.read(), type_handlers)
+			self.norm_parser[os.path.splitext(os.path.basename(path))] = StructParser(self._read_definition(os.path.basename(path)), type_handlers)
+
+	def _read_definition(self, path):
+		"""Read a struct definition file in packetdefinitions, recording its hash for the parse cache."""
+		with open(os.path.dirname(os.path.realpath(__file__))+"/packetdefinitions/"+path, encoding="utf-8") as file:
+			definition = file.read()
+		self.definition_hashes[path] = capturecache.key(definition)
+		return definition
+
+	def _all_parsers(self):
+		"""Yields (definition path in packetdefinitions, parser) for all struct parsers."""
+		yield "replica/creation_header.structs", self.creation_header_parser
+		yield "replica/serialization_header.structs", self.serialization_header_parser
+		for comp_id, parsers in self.comp_parser.items():
+			for index, parser in zip(component_name[comp_id], parsers):
+				yield "replica/components/"+index+".structs", parser
+		for (name, ext), parser in self.norm_parser.items():
+			yield name+ext, parser
 
 	def create_widgets(self):
 		super().create_widgets()
@@ -167,7 +391,15 @@ class CaptureViewer(viewer.Viewer):
 		parse_menu.add_checkbutton(label="Retry parsing with script component if failed", variable=self.retry_with_script_component)
 		parse_menu.add_checkbutton(label="Retry parsing with trigger component if failed", variable=self.retry_with_trigger_component)
 		parse_menu.add_checkbutton(label="Retry parsing with phantom component if failed", variable=self.retry_with_phantom_component)
+		parse_menu.add_checkbutton(label="Cache parse results next to the capture", variable=self.use_cache)
+		parse_menu.add_checkbutton(label="Profile struct definitions (parses without the cache)", variable=self.profile_parsers)
 		self.menubar.add_cascade(label="Parse", menu=parse_menu)
+		metrics_menu = Menu(self.menubar)
+		metrics_menu.add_command(label="Show Load Metrics", command=self._show_metrics)
+		metrics_menu.add_command(label="Save Load Metrics as JSON", command=self._save_metrics)
+		metrics_menu.add_command(label="Show Parser Profile", command=self._show_profiles)
+		metrics_menu.add_command(label="Save Parser Profile as Flamegraph Stacks", command=self._save_profiles)
+		self.menubar.add_cascade(label="Metrics", menu=metrics_menu)
 
 		self.set_headings("Name", treeheading="Packet", treewidth=1200)
 		self.tree.tag_configure("unexpected", foreground="medium blue")
@@ -180,40 +412,197 @@ class CaptureViewer(viewer.Viewer):
 
 	def load(self, captures) -> None:
 		self.objects = []
+		self.details = {}
+		self._object_indices = {}
+		self.metrics = []
+		self.profiles = []
+		for name, parser in self._all_parsers():
+			if self.profile_parsers.get():
+				self.profiles.append(parser.enable_profiling(name))
+			else:
+				parser.disable_profiling()
+		previous_captures = []
 		print("Loading captures, this might take a while")
 		for i, capture in enumerate(captures):
 			print("Loading", capture, "[%i/%i]" % (i+1, len(captures)))
-			with zipfile.ZipFile(capture) as capture:
+			self.metrics.append(CaptureMetrics(capture))
+			# objects of previously loaded captures can change the results
+			self._previous_captures = tuple(previous_captures)
+			cache = None
+			# cached packets aren't parsed, so they'd be missing from the profiles
+			if self.use_cache.get() and not self.profile_parsers.get():
+				try:
+					cache = capturecache.CaptureCache(capture)
+				except sqlite3.Error as e:
+					print("Not using the parse cache, can't write", capture+capturecache.CACHE_EXTENSION+":", e)
+				# also needed if this capture isn't cached, the later ones still depend on its objects
+				if cache is not None:
+					previous_captures.append(cache.capture_hash)
+				else:
+					previous_captures.append(capturecache.file_hash(capture))
+			with ZipMembers(capture) as capture:
 				self.set_superbar(self.parse_creations.get()+self.parse_serializations.get()+self.parse_game_messages.get()+self.parse_normal_packets.get())
 				files = [i for i in capture.namelist() if "of" not in i]
 
 				for _ in self.step_superbar(self.parse_creations.get(), "Parsing creations"):
 					print("Parsing creations")
 					creations = [i for i in files if "[24]" in i]
-					for packet_name in creations:
-						packet = ReadStream(capture.read(packet_name), unlocked=True)
-						self._parse_creation(packet_name, packet)
+					self._parse_packets(capture, "creations", creations, self._parse_creation, unlocked=True, cache=cache)
 
 				for _ in self.step_superbar(self.parse_serializations.get(), "Parsing serializations"):
 					print("Parsing serializations")
 					serializations = [i for i in files if "[27]" in i]
-					for packet_name in serializations:
-						packet = ReadStream(capture.read(packet_name)[1:])
-						self._parse_serialization_packet(packet_name, packet)
+					self._parse_packets(capture, "serializations", serializations, self._parse_serialization_packet, start=1, cache=cache)
 
 				for _ in self.step_superbar(self.parse_game_messages.get(), "Parsing game messages"):
 					print("Parsing game messages")
 					game_messages = [i for i in files if "[53-05-00-0c]" in i or "[53-04-00-05]" in i]
-					for packet_name in game_messages:
-						packet = ReadStream(capture.read(packet_name)[8:])
-						self._parse_game_message(packet_name, packet)
+					self._parse_packets(capture, "game_messages", game_messages, self._parse_game_message, start=8, cache=cache)
 
 				for _ in self.step_superbar(self.parse_normal_packets.get(), "Parsing normal packets"):
 					print("Parsing normal packets")
 					packets = [i for i in files if "[24]" not in i and "[27]" not in i and "[53-05-00-0c]" not in i and "[53-04-00-05]" not in i]
-					for packet_name in packets:
-						packet = ReadStream(capture.read(packet_name))
-						self._parse_normal_packet(packet_name, packet)
+					self._parse_packets(capture, "normal_packets", packets, self._parse_normal_packet, cache=cache)
+			if cache is not None:
+				cache.close()
+			print(self.metrics[-1].summary())
+
+	def _parse_packets(self, capture, stage, packet_names, parse_func, start=0, unlocked=False, cache=None):
+		capture_metrics = self.metrics[-1]
+		metrics = self._stage_metrics = capture_metrics.stages[stage]
+		stage_start = time.perf_counter()
+		cached = {} # kind: cached results, None if outdated
+		for packet_name in packet_names:
+			packet_start = time.perf_counter()
+			if cache is not None:
+				kind = self._cache_kind(stage, packet_name)
+				if kind not in cached:
+					key = self._cache_key(kind)
+					if cache.is_valid(kind, key):
+						cached[kind] = cache.results(kind)
+					else:
+						cache.reset(kind, key)
+						cached[kind] = None
+				if cached[kind] is not None and packet_name in cached[kind]:
+					self._insert_cached(cached[kind][packet_name])
+					metrics.cached += 1
+					continue
+				self._cache_rows = []
+			data, compress_type = capture.read_raw(packet_name)
+			decode_start = time.perf_counter()
+			packet = ReadStream(capture.decompress(data, compress_type), unlocked=unlocked)
+			if start:
+				packet.skip_read(start)
+			parse_start = time.perf_counter()
+			insert_time = metrics.insert_time
+			parse_func(packet_name, packet)
+			end = time.perf_counter()
+			metrics.packets += 1
+			metrics.zip_time += decode_start - packet_start
+			metrics.decode_time += parse_start - decode_start
+			metrics.parse_time += end - parse_start - (metrics.insert_time - insert_time)
+			capture_metrics.add_packet(end - packet_start, stage, packet_name)
+			if cache is not None:
+				cache.add(kind, packet_name, [(parent, obj_fields, text, values, tags, details.cache_data() if details is not None else None) for parent, obj_fields, text, values, tags, details in self._cache_rows])
+				self._cache_rows = None
+		metrics.time += time.perf_counter() - stage_start
+		self._stage_metrics = None
+
+	def _cache_kind(self, stage, packet_name):
+		"""Normal packets are cached by packet id, so that changing one definition doesn't invalidate the others."""
+		if stage == "normal_packets":
+			return stage+":"+packet_name[packet_name.index("[")+1:packet_name.index("]")]
+		return stage
+
+	def _cache_key(self, kind):
+		"""Key of everything the parse results of the kind depend on, see capturecache."""
+		db_stat = os.stat(self.db_path)
+		base = CACHE_VERSION, self.db_path, db_stat.st_size, db_stat.st_mtime, self._previous_captures
+		replica = sorted((path, hash_) for path, hash_ in self.definition_hashes.items() if path.startswith("replica/"))
+		if kind == "creations":
+			return capturecache.key(*base, replica, self.retry_with_script_component.get(), self.retry_with_trigger_component.get(), self.retry_with_phantom_component.get())
+		# object names and lots come from the creations
+		if self.parse_creations.get():
+			objects = self._cache_key("creations")
+		else:
+			objects = None
+		if kind == "serializations":
+			return capturecache.key(*base, objects, replica)
+		if kind == "game_messages":
+			# serializations of unknown objects add objects as well
+			return capturecache.key(*base, objects, self.parse_serializations.get(), self.definition_hashes["gm"])
+		id_ = kind.split(":", 1)[1]
+		return capturecache.key(*base, objects, self.definition_hashes.get(id_+".structs"))
+
+	def _insert_cached(self, rows):
+		"""Insert the cached entries of a packet, recreating the objects created with them."""
+		for parent, obj_fields, text, values, tags, details in rows:
+			obj = None
+			if obj_fields is not None:
+				network_id, object_id, lot, retry_with_components = obj_fields
+				obj = CaptureObject(network_id=network_id, object_id=object_id, lot=lot)
+				self.objects.append(obj)
+				if lot is not None and self.lot_retries.get(lot) != retry_with_components:
+					# recomputed on first use, with the components the creation was parsed with
+					self.lot_data.pop(lot, None)
+					self.lot_retries[lot] = retry_with_components
+			if parent is None:
+				parent = ""
+			else:
+				parent = self.objects[parent].entry
+			if details is not None:
+				details = details_from_cache(details)
+			self._tree_insert(parent, obj=obj, details=details, text=text, values=values, tags=tags)
+
+	def _tree_insert(self, parent, obj=None, details=None, **kwargs):
+		"""
+		Insert into the tree, recording the insert time and errors in the metrics of the current stage.
+		obj is the object the entry is created for, it needs to be the last one added to self.objects.
+		details is the ParserOutput or GameMessageOutput shown in the inspector when the entry is selected.
+		While a packet is parsed for the cache, the entry is also added to self._cache_rows.
+		"""
+		start = time.perf_counter()
+		entry = self.tree.insert(parent, END, **kwargs)
+		if details is not None:
+			self.details[entry] = details
+		if obj is not None:
+			obj.entry = entry
+			self._object_indices[entry] = len(self.objects)-1
+		if self._cache_rows is not None:
+			if obj is None:
+				obj_fields = None
+			else:
+				obj_fields = obj.network_id, obj.object_id, obj.lot, self.lot_retries.get(obj.lot, [])
+			self._cache_rows.append((self._object_indices.get(parent), obj_fields, kwargs.get("text", ""), kwargs.get("values", ()), kwargs.get("tags", []), details))
+		metrics = self._stage_metrics
+		if metrics is not None:
+			metrics.insert_time += time.perf_counter() - start
+			if any(tag in ERROR_TAGS for tag in kwargs.get("tags", ())):
+				metrics.errors += 1
+		return entry
+
+	def _show_metrics(self):
+		self.item_inspector.delete(1.0, END)
+		self.item_inspector.insert(END, "\n".join(metrics.summary() for metrics in self.metrics))
+
+	def _save_metrics(self):
+		path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON", "*.json")])
+		if path:
+			with open(path, "w") as file:
+				json.dump([metrics.to_dict() for metrics in self.metrics], file, indent="\t")
+
+	def _show_profiles(self):
+		self.item_inspector.delete(1.0, END)
+		if not self.profiles:
+			self.item_inspector.insert(END, "Enable Parse > Profile struct definitions and load a capture to profile the struct definitions.")
+			return
+		self.item_inspector.insert(END, format_profiles(self.profiles))
+
+	def _save_profiles(self):
+		path = filedialog.asksaveasfilename(defaultextension=".txt", filetypes=[("Collapsed stacks", "*.txt")])
+		if path:
+			with open(path, "w") as file:
+				write_collapsed_stacks(self.profiles, file)
 
 	def _object_id_handler(self, stream):
 		object_id = stream.read(c_int64)
@@ -245,17 +634,15 @@ class CaptureViewer(viewer.Viewer):
 			uncompressed = stream.read(bytes, length=size)
 		return ldf.from_ldf(ReadStream(uncompressed))
 
-	def _parse_creation(self, packet_name, packet, retry_with_components=[]):
-		packet.skip_read(1)
-		has_network_id = packet.read(c_bit)
-		assert has_network_id
-		network_id = packet.read(c_ushort)
-		object_id = packet.read(c_int64)
-		for obj in self.objects:
-			if obj.object_id == object_id: # We've already parsed this object (can happen due to ghosting)
-				return
-		lot = packet.read(c_int)
+	def _lot_data(self, lot, retry_with_components=None):
+		"""
+		Name, component parsers and error of a lot, computed on first use.
+		If retry_with_components is None, the components of the last creation of the lot are used, which may have been loaded from the parse cache.
+		"""
 		if lot not in self.lot_data:
+			if retry_with_components is None:
+				retry_with_components = self.lot_retries.get(lot, [])
+			self.lot_retries[lot] = retry_with_components
 			try:
 				lot_name = self.db.execute("select name from Objects where id == "+str(lot)).fetchone()[0]
 			except TypeError:
@@ -280,15 +667,27 @@ class CaptureViewer(viewer.Viewer):
 			else:
 				error = None
 			self.lot_data[lot] = lot_name, parsers, error
-		else:
-			lot_name, parsers, error = self.lot_data[lot]
+		return self.lot_data[lot]
+
+	def _parse_creation(self, packet_name, packet, retry_with_components=[]):
+		attempt_start = time.perf_counter()
+		packet.skip_read(1)
+		has_network_id = packet.read(c_bit)
+		assert has_network_id
+		network_id = packet.read(c_ushort)
+		object_id = packet.read(c_int64)
+		for obj in self.objects:
+			if obj.object_id == object_id: # We've already parsed this object (can happen due to ghosting)
+				return
+		lot = packet.read(c_int)
+		lot_name, parsers, error = self._lot_data(lot, retry_with_components)
 		id_ = packet.read(str, length_type=c_ubyte) + " " + lot_name
 		packet.read_offset = 0
 		parser_output = ParserOutput()
 		with parser_output:
 			parser_output.append(self.creation_header_parser.parse(packet))
 			if error is not None:
-				parser_output.text = error+"\n"+parser_output.text
+				parser_output.add_line(error, first=True)
 				parser_output.tags.append("error")
 			else:
 				try:
@@ -307,6 +706,9 @@ class CaptureViewer(viewer.Viewer):
 
 					if retry_with_components:
 						print("retrying with", retry_with_components, packet_name)
+						if self._stage_metrics is not None:
+							self._stage_metrics.retries += 1
+							self._stage_metrics.retry_time += time.perf_counter() - attempt_start
 						del self.lot_data[lot]
 						packet.read_offset = 0
 						self._parse_creation(packet_name, packet, retry_with_components)
@@ -314,12 +716,12 @@ class CaptureViewer(viewer.Viewer):
 
 		obj = CaptureObject(network_id=network_id, object_id=object_id, lot=lot)
 		self.objects.append(obj)
-		obj.entry = self.tree.insert("", END, text=packet_name, values=(id_, parser_output.text.replace("{", "<crlbrktopen>").replace("}", "<crlbrktclose>").replace("\\", "<backslash>")), tags=parser_output.tags)
+		self._tree_insert("", obj=obj, details=parser_output, text=packet_name, values=(id_,), tags=parser_output.tags)
 
 	def _parse_serialization(self, packet, parser_output, parsers, is_creation=False):
 		parser_output.append(self.serialization_header_parser.parse(packet))
 		for name, parser in parsers.items():
-			parser_output.text += "\n"+name+"\n\n"
+			parser_output.add_line(sys.intern("\n"+name+"\n"))
 			parser_output.append(parser.parse(packet, {"creation":is_creation}))
 		if not packet.all_read():
 			raise IndexError("Not completely read, %i bytes unread" % len(packet.read_remaining()))
@@ -334,13 +736,13 @@ class CaptureViewer(viewer.Viewer):
 		if obj is None:
 			obj = CaptureObject(network_id=network_id)
 			self.objects.append(obj)
-			obj.entry = self.tree.insert("", END, text="Unknown", values=("network_id="+str(network_id), ""))
+			self._tree_insert("", obj=obj, text="Unknown", values=("network_id="+str(network_id),))
 
 		if obj.lot is None:
 			parsers = {}
 			error = "Unknown object"
 		else:
-			_, parsers, error = self.lot_data[obj.lot]
+			_, parsers, error = self._lot_data(obj.lot)
 
 		parser_output = ParserOutput()
 		with parser_output:
@@ -349,7 +751,7 @@ class CaptureViewer(viewer.Viewer):
 			parser_output.tags.append("error")
 		else:
 			error = ""
-		self.tree.insert(obj.entry, END, text=packet_name, values=(error, parser_output.text.replace("{", "<crlbrktopen>").replace("}", "<crlbrktclose>").replace("\\", "<backslash>")), tags=parser_output.tags)
+		self._tree_insert(obj.entry, details=parser_output, text=packet_name, values=(error,), tags=parser_output.tags)
 
 	def _parse_game_message(self, packet_name, packet):
 		object_id = packet.read(c_int64)
@@ -360,7 +762,7 @@ class CaptureViewer(viewer.Viewer):
 		else:
 			obj = CaptureObject(object_id=object_id)
 			self.objects.append(obj)
-			obj.entry = entry = self.tree.insert("", END, text="Unknown", values=("object_id="+str(object_id), ""))
+			entry = self._tree_insert("", obj=obj, text="Unknown", values=("object_id="+str(object_id),))
 
 		msg_id = packet.read(c_ushort)
 
@@ -586,7 +988,6 @@ class CaptureViewer(viewer.Viewer):
 					param_values["team_members"] = team_members
 				else:
 					raise NotImplementedError("Custom serialization")
-				values = "\n".join(["%s = %s" % (a, b) for a, b in param_values.items()])
 			else:
 				for param in params:
 					type_ = param["type"]
@@ -649,22 +1050,27 @@ class CaptureViewer(viewer.Viewer):
 			if not packet.all_read():
 				raise ValueError
 		except NotImplementedError as e:
-			values = (msg_name, str(e)+"\n"+"\n".join(["%s = %s" % (a, b) for a, b in param_values.items()]))
+			name = msg_name
+			details = GameMessageOutput(param_values, str(e), pretty=False)
 			tags.append("error")
 		except Exception as e:
 			print(packet_name, msg_name)
 			import traceback
 			traceback.print_exc()
-			values = ("likely not "+msg_name, "Error while parsing, likely not this message!\n"+str(e)+"\n"+"\n".join(["%s = %s" % (a, b) for a, b in param_values.items()]))
+			name = "likely not "+msg_name
+			details = GameMessageOutput(param_values, "Error while parsing, likely not this message!\n"+str(e), pretty=False)
 			tags.append("error")
 		else:
-			values = (msg_name, "\n".join(["%s = %s" % (a, pprint.pformat(b)) for a, b in param_values.items()]))
-		self.tree.insert(entry, END, text=packet_name, values=values, tags=tags)
+			name = msg_name
+			details = GameMessageOutput(param_values)
+		self._tree_insert(entry, details=details, text=packet_name, values=(name,), tags=tags)
 
 	def _parse_normal_packet(self, packet_name, packet):
 		id_ = packet_name[packet_name.index("[")+1:packet_name.index("]")]
 		if id_ not in self.norm_parser:
-			self.tree.insert("", END, text=packet_name, values=(id_, "Add the struct definition file packetdefinitions/"+id_+".structs to enable parsing of this packet."), tags=["error"])
+			parser_output = ParserOutput()
+			parser_output.add_line("Add the struct definition file packetdefinitions/"+id_+".structs to enable parsing of this packet.")
+			self._tree_insert("", details=parser_output, text=packet_name, values=(id_,), tags=["error"])
 			return
 		if id_.startswith("53"):
 			packet.skip_read(8)
@@ -673,12 +1079,16 @@ class CaptureViewer(viewer.Viewer):
 		parser_output = ParserOutput()
 		with parser_output:
 			parser_output.append(self.norm_parser[id_].parse(packet))
-		self.tree.insert("", END, text=packet_name, values=(id_, parser_output.text), tags=parser_output.tags)
+		self._tree_insert("", details=parser_output, text=packet_name, values=(id_,), tags=parser_output.tags)
 
 	def on_item_select(self, _):
 		item = self.tree.selection()[0]
 		self.item_inspector.delete(1.0, END)
-		self.item_inspector.insert(END, self.tree.item(item, "values")[1])
+		if item in self.details:
+			self.item_inspector.insert(END, self.details[item].render())
+
+	def _item_matches(self, item, query):
+		return super()._item_matches(item, query) or (item in self.details and self.details[item].matches(query))
 
 if __name__ == "__main__":
 	app = CaptureViewer()
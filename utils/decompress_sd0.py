@@ -2,6 +2,16 @@ import argparse
 import os.path
 import zlib
 
+CHUNK_SIZE = 1024*256
+
+def compress(data, level=zlib.Z_DEFAULT_COMPRESSION):
+	out = bytearray(b"sd0\x01\xff")
+	for pos in range(0, len(data), CHUNK_SIZE):
+		chunk = zlib.compress(data[pos:pos+CHUNK_SIZE], level)
+		out += len(chunk).to_bytes(4, "little")
+		out += chunk
+	return bytes(out)
+
 def decompress(data):
 	assert data[:5] == b"sd0\x01\xff"
 	pos = 5
@@ -1,20 +1,397 @@
 import argparse
+import functools
+import multiprocessing
 import os
 import re
+import sqlite3
+import struct
 import zipfile
 
+from bitstream import c_int, c_int64, ReadStream
+from structparser import StructParser
+from zipmembers import ZipMembers, as_bytes
+
+PACKET_ID = re.compile(r"\[([0-9a-fA-F]{2}(?:-[0-9a-fA-F]{2})*)\]")
+
+# remote connection types of 0x53 (LU) packets, the second id byte is the receiving end
+TO_SERVER = 1, 2, 4 # auth, chat, world
+TO_CLIENT = 5,
+# replica packets are only ever sent by the server
+REPLICA_IDS = "24", "25", "27"
+# increase when changing what is indexed, indexes with a different version are rebuilt
+INDEX_VERSION = 1
+
+INT_FORMATS = {}
+INT_FORMATS["s8"] = "<b"
+INT_FORMATS["u8"] = "<B"
+INT_FORMATS["s16"] = "<h"
+INT_FORMATS["u16"] = "<H"
+INT_FORMATS["s32"] = "<i"
+INT_FORMATS["u32"] = "<I"
+INT_FORMATS["s64"] = "<q"
+INT_FORMATS["u64"] = "<Q"
+
+# custom types used in the replica definitions, parsed as plain values since there's no database to look up names
+STRUCT_TYPE_HANDLERS = {}
+STRUCT_TYPE_HANDLERS["object_id"] = lambda stream: stream.read(c_int64)
+STRUCT_TYPE_HANDLERS["lot"] = lambda stream: stream.read(c_int)
+
 def find_packets(capture_dir, pattern):
 	zips = [os.path.join(dirpath, f) for dirpath, dirnames, files in os.walk(capture_dir) for f in files if f.endswith('.zip')]
 	for zip_path in zips:
-		with zipfile.ZipFile(zip_path) as zip:
+		with ZipMembers(zip_path) as zip:
 			filenames = [i for i in zip.namelist() if re.search(re.escape(pattern), i) is not None and "of" not in i]
 			for filename in filenames:
 				yield os.path.join(zip_path, filename), zip.read(filename)
 
+def packet_info(name):
+	"""
+	Get the packet id and direction from a packet file name in our capture naming format.
+	Returns:
+		A tuple (packet id as hex string like "53-05-00-0c", packet id bytes, direction), direction being "to_server", "to_client" or None if unknown. The id values are None if the name doesn't contain an id.
+	"""
+	match = PACKET_ID.search(name)
+	if match is None:
+		return None, None, None
+	id_ = match.group(1).lower()
+	id_bytes = bytes.fromhex(id_.replace("-", ""))
+	direction = None
+	if id_bytes[0] == 0x53 and len(id_bytes) > 1:
+		if id_bytes[1] in TO_SERVER:
+			direction = "to_server"
+		elif id_bytes[1] in TO_CLIENT:
+			direction = "to_client"
+	elif id_ in REPLICA_IDS:
+		direction = "to_client"
+	return id_, id_bytes, direction
+
+class PacketIndex:
+	"""
+	Persistent index of the packets in a directory of capture zips, stored in a SQLite database.
+	Archives are only (re)scanned if they are new or their mtime or size changed since the last scan.
+	"""
+	def __init__(self, index_path):
+		self.db = sqlite3.connect(index_path)
+		if self.db.execute("pragma user_version").fetchone()[0] != INDEX_VERSION:
+			for table in ("archives", "packets"):
+				self.db.execute("drop table if exists "+table)
+			self.db.execute("pragma user_version = %i" % INDEX_VERSION)
+		self.db.execute("create table if not exists archives (path text primary key, mtime real, size integer)")
+		self.db.execute("create table if not exists packets (archive text, name text, packet_id text, packet_id_bytes blob, direction text, size integer)")
+		self.db.execute("create index if not exists packets_archive on packets (archive)")
+		self.db.execute("create index if not exists packets_packet_id on packets (packet_id)")
+		self.db.commit()
+
+	def close(self):
+		self.db.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.close()
+
+	def update(self, capture_dir):
+		"""
+		Bring the index up to date with the zips in capture_dir.
+		Returns:
+			The number of archives that were (re)scanned.
+		"""
+		capture_dir = os.path.abspath(capture_dir)
+		zips = [os.path.join(dirpath, f) for dirpath, dirnames, files in os.walk(capture_dir) for f in files if f.endswith('.zip')]
+		indexed = {path: (mtime, size) for path, mtime, size in self.db.execute("select path, mtime, size from archives")}
+		capture_dir = os.path.join(capture_dir, "")
+		zip_set = set(zips)
+		for path in indexed:
+			if path.startswith(capture_dir) and path not in zip_set:
+				self._remove(path)
+
+		scanned = 0
+		for zip_path in zips:
+			stat = os.stat(zip_path)
+			if indexed.get(zip_path) == (stat.st_mtime, stat.st_size):
+				continue
+			self._remove(zip_path)
+			try:
+				self._scan(zip_path)
+			except zipfile.BadZipFile:
+				print("Skipping invalid zip", zip_path)
+				continue
+			self.db.execute("insert into archives values (?, ?, ?)", (zip_path, stat.st_mtime, stat.st_size))
+			self.db.commit()
+			scanned += 1
+		self.db.commit()
+		return scanned
+
+	def _remove(self, zip_path):
+		self.db.execute("delete from packets where archive == ?", (zip_path,))
+		self.db.execute("delete from archives where path == ?", (zip_path,))
+
+	def _scan(self, zip_path):
+		rows = []
+		with zipfile.ZipFile(zip_path) as zip:
+			for info in zip.infolist():
+				if "of" in info.filename:
+					continue
+				id_, id_bytes, direction = packet_info(info.filename)
+				rows.append((zip_path, info.filename, id_, id_bytes, direction, info.file_size))
+		self.db.executemany("insert into packets values (?, ?, ?, ?, ?, ?)", rows)
+
+	def query(self, packet_id=None, prefix=None, glob=None, direction=None, capture_dir=None):
+		"""
+		Look up packets in the index. All given criteria have to match.
+		Arguments:
+			capture_dir: Only packets of zips in this directory (or below it), for indexes shared by several capture directories.
+			packet_id: Exact packet id, as hex string ("53-05-00-0c") or bytes.
+			prefix: Packet id prefix, as hex string ("53-05") or bytes.
+			glob: Glob pattern matched against the packet file name.
+			direction: "to_server" or "to_client".
+		Yields:
+			Tuples (zip path, packet file name, packet id, direction, size).
+		"""
+		conditions = []
+		args = []
+		if capture_dir is not None:
+			capture_dir = os.path.join(os.path.abspath(capture_dir), "")
+			# a range instead of like/startswith so the archive index is used, the bound is the directory with its separator incremented
+			conditions.append("archive >= ? and archive < ?")
+			args.extend((capture_dir, capture_dir[:-1]+chr(ord(capture_dir[-1])+1)))
+		if packet_id is not None:
+			conditions.append("packet_id == ?")
+			args.append(self._to_id(packet_id))
+		if prefix is not None:
+			prefix = self._to_id(prefix)
+			# a range instead of substr() so the packet id index is used, ids only contain characters below 0x7f
+			conditions.append("packet_id >= ? and packet_id < ?")
+			args.extend((prefix, prefix+chr(0x7f)))
+		if glob is not None:
+			conditions.append("name glob ?")
+			args.append(glob)
+		if direction is not None:
+			conditions.append("direction == ?")
+			args.append(direction)
+		sql = "select archive, name, packet_id, direction, size from packets"
+		if conditions:
+			sql += " where "+" and ".join(conditions)
+		sql += " order by archive, rowid"
+		yield from self.db.execute(sql, args)
+
+	@staticmethod
+	def _to_id(id_):
+		if isinstance(id_, bytes):
+			return "-".join("%02x" % i for i in id_)
+		return id_.lower()
+
+def find_indexed_packets(capture_dir, index_path, packet_id=None, prefix=None, glob=None, direction=None):
+	"""Like find_packets, but updates and queries a persistent packet index instead of scanning every zip."""
+	with PacketIndex(index_path) as index:
+		index.update(capture_dir)
+		zip = None
+		for zip_path, filename, _, _, _ in index.query(packet_id, prefix, glob, direction, capture_dir):
+			if zip is None or zip.filename != zip_path:
+				if zip is not None:
+					zip.close()
+				zip = ZipMembers(zip_path)
+			yield os.path.join(zip_path, filename), zip.read(filename)
+		if zip is not None:
+			zip.close()
+
+class BytesMatcher:
+	"""
+	Matches packets whose payload contains the given bytes.
+	Arguments:
+		pattern: The bytes to search for.
+		at: If not None, only match if the pattern is at this byte offset of the payload.
+	"""
+	def __init__(self, pattern, at=None):
+		self.pattern = pattern
+		self.at = at
+		# unlike bytes.find, regexes search memoryviews in place
+		self._regex = re.compile(re.escape(pattern))
+
+	def __call__(self, name, data):
+		"""Returns the offset of the first match or None."""
+		if self.at is not None:
+			if data[self.at:self.at+len(self.pattern)] == self.pattern:
+				return self.at
+			return None
+		match = self._regex.search(data)
+		if match is None:
+			return None
+		return match.start()
+
+def int_matcher(type_, value, at=None):
+	"""Matches packets containing an integer, type_ being one of INT_FORMATS ("u32", "s64", ...)."""
+	return BytesMatcher(struct.pack(INT_FORMATS[type_], value), at)
+
+class StructMatcher:
+	"""
+	Matches packets by parsing them with a struct definition and evaluating a predicate on the parsed values.
+	Arguments:
+		definition: A string of structure definitions, see structparser.
+		predicate: Python expression. Variables assigned in the definition are available by name, additionally "fields" maps descriptions to the (last) parsed value and "values" is the list of all parsed values.
+		skip: Number of bytes to skip before parsing. If None, skip the packet header like the captureviewer does (8 bytes for LU packets, nothing for creations, 1 byte otherwise).
+	Packets that fail to parse don't match.
+	"""
+	def __init__(self, definition, predicate, skip=None):
+		self.definition = definition
+		self.predicate = predicate
+		self.skip = skip
+		# compiled lazily, so that the matcher can be sent to worker processes
+		self._parser = None
+		self._predicate = None
+
+	def __getstate__(self):
+		return self.definition, self.predicate, self.skip
+
+	def __setstate__(self, state):
+		self.__init__(*state)
+
+	def __call__(self, name, data):
+		"""Returns the parsed variables if the predicate is true, else None."""
+		if self._parser is None:
+			self._parser = StructParser(self.definition, STRUCT_TYPE_HANDLERS)
+			self._predicate = compile(self.predicate, "<predicate>", "eval")
+		skip = self.skip
+		if skip is None:
+			id_, _, _ = packet_info(name)
+			if id_ is not None and id_.startswith("53"):
+				skip = 8
+			elif id_ == "24":
+				skip = 0
+			else:
+				skip = 1
+		variables = {}
+		fields = {}
+		values = []
+		stream = ReadStream(as_bytes(data))
+		try:
+			stream.skip_read(skip)
+			for structure in self._parser.parse(stream, variables):
+				fields[structure.description] = structure.value
+				values.append(structure.value)
+		except Exception:
+			return None
+		globals_ = {"__builtins__": {}, "fields": fields, "values": values}
+		globals_.update(variables)
+		try:
+			if eval(self._predicate, globals_):
+				return variables
+		except Exception:
+			pass
+		return None
+
+# zip of the last batch of a worker process, batches of a zip are consecutive so its central directory is only read once
+_worker_zip = None
+
+def _search_batch(matcher, task):
+	global _worker_zip
+	zip_path, filenames = task
+	if _worker_zip is None or _worker_zip.filename != zip_path:
+		if _worker_zip is not None:
+			_worker_zip.close()
+		_worker_zip = ZipMembers(zip_path)
+	hits = []
+	for filename in filenames:
+		data = _worker_zip.view(filename)
+		result = matcher(filename, data)
+		data.release()
+		if result is not None:
+			hits.append((os.path.join(zip_path, filename), result))
+	return hits
+
+def _batches(packets, batch_size):
+	zip_path = None
+	batch = []
+	for packet_zip_path, filename in packets:
+		if packet_zip_path != zip_path or len(batch) == batch_size:
+			if batch:
+				yield zip_path, batch
+			zip_path = packet_zip_path
+			batch = []
+		batch.append(filename)
+	if batch:
+		yield zip_path, batch
+
+def search_packets(packets, matcher, processes=None, max_hits=None, batch_size=256):
+	"""
+	Search packet payloads in parallel on a process pool.
+	Arguments:
+		packets: Iterable of (zip path, packet file name) to search. Packets of the same zip should be consecutive.
+		matcher: Picklable callable (packet file name, payload) returning None if the packet doesn't match, see BytesMatcher and StructMatcher. The payload is a memoryview, over the mapped zip file for uncompressed members.
+		processes: Number of worker processes, defaults to the number of cores.
+		max_hits: Stop after this many hits.
+		batch_size: Number of packets per task sent to a worker.
+	Yields:
+		Tuples (path, matcher result) as soon as they're found. The order is not deterministic.
+	"""
+	if max_hits is not None and max_hits <= 0:
+		return
+	hits = 0
+	with multiprocessing.Pool(processes) as pool:
+		for results in pool.imap_unordered(functools.partial(_search_batch, matcher), _batches(packets, batch_size)):
+			for hit in results:
+				yield hit
+				hits += 1
+				if hits == max_hits:
+					return
+
+def iter_packets(capture_dir, pattern=""):
+	"""Yields (zip path, packet file name) for all packets in capture_dir whose name contains pattern, like find_packets."""
+	zips = [os.path.join(dirpath, f) for dirpath, dirnames, files in os.walk(capture_dir) for f in files if f.endswith('.zip')]
+	for zip_path in zips:
+		with zipfile.ZipFile(zip_path) as zip:
+			for filename in zip.namelist():
+				if pattern in filename and "of" not in filename:
+					yield zip_path, filename
+
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
 	parser.add_argument("capture_dir")
-	parser.add_argument("pattern")
+	parser.add_argument("pattern", nargs="?", help="Substring of the packet file name, scans all zips. Not used if --index is given.")
+	parser.add_argument("--index", help="Path of a packet index database, created if it doesn't exist. Only new or changed zips are scanned.")
+	parser.add_argument("--id", help="With --index: exact packet id, like 53-05-00-0c")
+	parser.add_argument("--prefix", help="With --index: packet id prefix, like 53-05")
+	parser.add_argument("--glob", help="With --index: glob pattern for the packet file name")
+	parser.add_argument("--direction", choices=("to_server", "to_client"), help="With --index: packet direction")
+	content = parser.add_argument_group("payload search", "Search the packet contents instead of only listing the packets. Uses all cores.")
+	content.add_argument("--contains", help="hex bytes the payload has to contain, like \"0c 00\"")
+	content.add_argument("--int", help="little-endian integer the payload has to contain, as type:value, like s64:1152921504606846976. Types: "+", ".join(INT_FORMATS))
+	content.add_argument("--at", type=int, help="with --contains or --int: only match at this byte offset")
+	content.add_argument("--struct", help="struct definition file to parse the payloads with")
+	content.add_argument("--where", help="with --struct: Python expression on the parsed values that has to be true")
+	content.add_argument("--skip", type=int, help="with --struct: bytes to skip before parsing, by default the packet header is skipped")
+	content.add_argument("--max_hits", type=int, help="stop after this many hits")
+	content.add_argument("--processes", type=int, help="number of worker processes, defaults to the number of cores")
 	args = parser.parse_args()
-	for filename, data in find_packets(args.capture_dir, args.pattern):
-		print(filename)
+
+	if args.contains is not None:
+		matcher = BytesMatcher(bytes.fromhex(args.contains), args.at)
+	elif args.int is not None:
+		type_, value = args.int.split(":")
+		matcher = int_matcher(type_, int(value, 0), args.at)
+	elif args.struct is not None:
+		if args.where is None:
+			parser.error("--struct requires --where")
+		with open(args.struct, encoding="utf-8") as file:
+			matcher = StructMatcher(file.read(), args.where, args.skip)
+	else:
+		matcher = None
+
+	if args.index is not None:
+		with PacketIndex(args.index) as index:
+			print("Rescanned", index.update(args.capture_dir), "archives")
+			packets = [row[:2] for row in index.query(args.id, args.prefix, args.glob, args.direction, args.capture_dir)]
+	elif args.pattern is not None:
+		packets = iter_packets(args.capture_dir, args.pattern)
+	elif matcher is not None:
+		packets = iter_packets(args.capture_dir)
+	else:
+		parser.error("pattern is required if neither --index nor a payload search is given")
+
+	if matcher is None:
+		for zip_path, filename in packets:
+			print(os.path.join(zip_path, filename))
+	else:
+		for filename, result in search_packets(packets, matcher, args.processes, args.max_hits):
+			print(filename, result)
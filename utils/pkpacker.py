@@ -0,0 +1,118 @@
+"""Module for packing files into a .pk archive, the format read by pkextractor."""
+import argparse
+import hashlib
+import multiprocessing
+import os
+import struct
+import zlib
+
+import decompress_sd0
+
+PK_HEADER = b"ndpk\x01\xff\x00"
+DATA_TERMINATOR = b"\xff\x00\x00\xdd\x00"
+RECORD = struct.Struct("<IiiI32sII32sII?BBB")
+# trunk.txt has 3 lines before the file list, pkextractor skips them
+MANIFEST_HEADER = "[version]", "1", "[files]"
+
+def path_crc(path):
+	"""
+	Key the records are sorted and searched by.
+	CRC32 of the lowercase path with backslashes and 4 null bytes appended, without the final inversion.
+	"""
+	path = path.lower().replace("/", "\\").encode("latin1")
+	return zlib.crc32(path+bytes(4)) ^ 0xffffffff
+
+def read_manifest(path):
+	"""Paths of the files listed in a trunk.txt-style manifest."""
+	with open(path) as file:
+		return [line.split(",")[0] for line in file.read().splitlines()[len(MANIFEST_HEADER):] if line]
+
+def walk(root):
+	"""Paths of all files below root, relative to it."""
+	names = []
+	for dir, _, files in os.walk(root):
+		for file in files:
+			names.append(os.path.relpath(os.path.join(dir, file), root).replace(os.sep, "/"))
+	return sorted(names)
+
+def _tree_links(count):
+	"""Lower and upper record index of each record, the records sorted by crc form a balanced binary search tree rooted at the middle one."""
+	links = [(-1, -1)]*count
+	def build(lo, hi):
+		if lo >= hi:
+			return -1
+		mid = (lo+hi)//2
+		links[mid] = build(lo, mid), build(mid+1, hi)
+		return mid
+	build(0, count)
+	return links
+
+def _pack_file(task):
+	"""Compress a file and compute both hashes in one pass. Files that don't get smaller are stored uncompressed."""
+	root, name, level = task
+	with open(os.path.join(root, name), "rb") as file:
+		data = file.read()
+	original_md5 = hashlib.md5(data).hexdigest()
+	compressed = decompress_sd0.compress(data, level)
+	if len(compressed) < len(data):
+		return name, len(data), original_md5, compressed, hashlib.md5(compressed).hexdigest(), True
+	return name, len(data), original_md5, data, original_md5, False
+
+def pack(root, out_path, names=None, manifest_out=None, processes=None, level=zlib.Z_DEFAULT_COMPRESSION):
+	"""
+	Pack the files below root into a .pk archive.
+	names: paths relative to root to pack, all files if None.
+	manifest_out: if set, write a trunk.txt-style manifest of the packed files there.
+	processes: number of worker processes compressing files, defaults to the number of CPUs.
+	Returns the number of packed files and the number of unique contents actually stored.
+	"""
+	if names is None:
+		names = walk(root)
+	names = list(dict.fromkeys(names))
+
+	stored = {} # original md5: data position, stored size, compressed md5, is compressed
+	entries = []
+	with multiprocessing.Pool(processes) as pool, open(out_path, "wb") as file:
+		file.write(PK_HEADER)
+		for name, original_size, original_md5, data, compressed_md5, is_compressed in pool.imap(_pack_file, [(root, name, level) for name in names]):
+			if original_md5 not in stored:
+				if file.tell()+len(data) > 0xffffffff:
+					raise ValueError("pk files are limited to 4 GiB, split the files over multiple pks")
+				stored[original_md5] = file.tell(), len(data), compressed_md5, is_compressed
+				file.write(data)
+				file.write(DATA_TERMINATOR)
+			entries.append((path_crc(name), name, original_size, original_md5))
+
+		entries.sort()
+		records_address = file.tell()
+		file.write(struct.pack("<I", len(entries)))
+		for (crc, name, original_size, original_md5), (lower, upper) in zip(entries, _tree_links(len(entries))):
+			data_position, stored_size, compressed_md5, is_compressed = stored[original_md5]
+			file.write(RECORD.pack(crc, lower, upper, original_size, original_md5.encode(), 0, stored_size, compressed_md5.encode(), 0, data_position, is_compressed, 0, 0, 0))
+		file.write(struct.pack("<II", records_address, 0))
+
+	if manifest_out is not None:
+		with open(manifest_out, "w") as file:
+			for line in MANIFEST_HEADER:
+				file.write(line+"\n")
+			for _, name, original_size, original_md5 in sorted(entries, key=lambda entry: entry[1]):
+				_, stored_size, compressed_md5, _ = stored[original_md5]
+				file.write("%s,%i,%s,%i,%s\n" % (name, original_size, original_md5, stored_size, compressed_md5))
+
+	return len(entries), len(stored)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("in_dir")
+	parser.add_argument("out_path")
+	parser.add_argument("--manifest", help="trunk.txt-style file list to pack, paths relative to in_dir. If not provided, all files in in_dir are packed")
+	parser.add_argument("--manifest_out", help="Write a trunk.txt-style manifest of the packed files to this path")
+	parser.add_argument("--processes", type=int, help="Number of worker processes, defaults to the number of CPUs")
+	parser.add_argument("--level", type=int, default=zlib.Z_DEFAULT_COMPRESSION, help="zlib compression level")
+	args = parser.parse_args()
+
+	names = None
+	if args.manifest is not None:
+		names = read_manifest(args.manifest)
+	files, unique = pack(args.in_dir, args.out_path, names, args.manifest_out, args.processes, args.level)
+	print("Packed %i files (%i unique) into %s" % (files, unique, args.out_path))
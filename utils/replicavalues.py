@@ -0,0 +1,40 @@
+"""Module for generating random values for the replica struct definitions, to write synthetic replica packets with StructSerializer (used by the benchmark and the StructSerializer tests)."""
+from bitstream import c_int32, c_int64, c_uint32
+
+# values for the asserts of the creation header, random ones would never pass them
+CREATION_HEADER_VALUES = {"Replica packet ID": 0x24, "Whether NetworkID is there": True}
+STRINGS = "brick", "minifig", "nexus", "maelstrom"
+
+# custom types of the replica definitions, as type_handlers for StructParser and type_writers for StructSerializer
+TYPE_HANDLERS = {}
+TYPE_HANDLERS["object_id"] = lambda stream: stream.read(c_int64)
+TYPE_HANDLERS["lot"] = lambda stream: stream.read(c_int32)
+TYPE_HANDLERS["compressed_ldf"] = lambda stream: stream.read(bytes, length=stream.read(c_uint32)+1)
+
+TYPE_WRITERS = {}
+TYPE_WRITERS["object_id"] = lambda stream, value: stream.write(c_int64(value))
+TYPE_WRITERS["lot"] = lambda stream, value: stream.write(c_int32(value))
+TYPE_WRITERS["compressed_ldf"] = lambda stream, value: stream.write(b"\x04\0\0\0\0\0\0\0\0") # uncompressed empty LDF
+
+def random_values(rng, overrides={}, strings=STRINGS):
+	"""
+	Value callback for StructSerializer.serialize writing random values.
+	Arguments:
+		rng: The random.Random to draw the values from.
+		overrides: Values to use instead, by variable name or description, e.g. CREATION_HEADER_VALUES.
+		strings: Words to pick string values from.
+	Random values can fail the asserts of a definition, parse the result with StructParser to check.
+	"""
+	def next_value(key, type_):
+		if key in overrides:
+			return overrides[key]
+		if type_ == "bit":
+			return rng.random() < 0.5
+		if type_ in ("float", "double"):
+			return rng.uniform(-1000, 1000)
+		if "wstring" in type_:
+			return rng.choice(strings)
+		if "string" in type_:
+			return rng.choice(strings).encode()
+		return rng.randrange(3)
+	return next_value
@@ -0,0 +1,265 @@
+"""Module for converting a SQLite database (as created by fdb_to_sqlite) to a FDB database"""
+import argparse
+import os
+import sqlite3
+import struct
+
+from fdb_to_sqlite import SQLITE_TYPE
+
+FDB_TYPE = {sqlite_type: data_type for data_type, sqlite_type in SQLITE_TYPE.items()}
+# for tables that weren't created by fdb_to_sqlite
+FDB_TYPE["integer"] = 1
+FDB_TYPE["int"] = 1
+FDB_TYPE["real"] = 3
+FDB_TYPE["float"] = 3
+FDB_TYPE["text"] = 8
+FDB_TYPE["boolean"] = 5
+FDB_TYPE["bigint"] = 6
+
+LINK_INFO_COLUMNS = ["_linked_from", "_does_link", "_invalid"]
+
+INT32_PAIR = struct.Struct("<ii")
+INT32_FLOAT = struct.Struct("<if")
+INT32_BOOL = struct.Struct("<i?xxx")
+INT64 = struct.Struct("<q")
+INT32_MIN, INT32_MAX = -2**31, 2**31-1
+
+def sfhash(data):
+	"""Paul Hsieh's SuperFastHash, used by LU to hash string keys into buckets."""
+	length = len(data)
+	if length == 0:
+		return 0
+	hash_ = length
+	remainder = length & 3
+	for pos in range(0, length - remainder, 4):
+		hash_ = (hash_ + (data[pos] | data[pos+1] << 8)) & 0xffffffff
+		tmp = (((data[pos+2] | data[pos+3] << 8) << 11) ^ hash_) & 0xffffffff
+		hash_ = ((hash_ << 16) ^ tmp) & 0xffffffff
+		hash_ = (hash_ + (hash_ >> 11)) & 0xffffffff
+	pos = length - remainder
+	# the remaining single bytes are signed chars in the original
+	if remainder == 3:
+		hash_ = (hash_ + (data[pos] | data[pos+1] << 8)) & 0xffffffff
+		hash_ ^= (hash_ << 16) & 0xffffffff
+		hash_ ^= ((data[pos+2] - 256 if data[pos+2] > 127 else data[pos+2]) << 18) & 0xffffffff
+		hash_ = (hash_ + (hash_ >> 11)) & 0xffffffff
+	elif remainder == 2:
+		hash_ = (hash_ + (data[pos] | data[pos+1] << 8)) & 0xffffffff
+		hash_ ^= (hash_ << 11) & 0xffffffff
+		hash_ = (hash_ + (hash_ >> 17)) & 0xffffffff
+	elif remainder == 1:
+		hash_ = (hash_ + (data[pos] - 256 if data[pos] > 127 else data[pos])) & 0xffffffff
+		hash_ ^= (hash_ << 10) & 0xffffffff
+		hash_ = (hash_ + (hash_ >> 1)) & 0xffffffff
+
+	hash_ ^= (hash_ << 3) & 0xffffffff
+	hash_ = (hash_ + (hash_ >> 5)) & 0xffffffff
+	hash_ ^= (hash_ << 4) & 0xffffffff
+	hash_ = (hash_ + (hash_ >> 17)) & 0xffffffff
+	hash_ ^= (hash_ << 25) & 0xffffffff
+	hash_ = (hash_ + (hash_ >> 6)) & 0xffffffff
+	return hash_
+
+def key_hash(value):
+	"""Hash of a primary key (first column) value, the bucket is this modulo the number of buckets."""
+	if value is None:
+		return 0
+	if isinstance(value, str):
+		return sfhash(value.encode("latin1"))
+	if isinstance(value, float):
+		return struct.unpack("<I", struct.pack("<f", value))[0]
+	return int(value) & 0xffffffff
+
+# I'm using a class for this to save things like the fdb and the sqlite without using globals
+class convert:
+	def __init__(self, in_file, out_file=None):
+		if out_file == None:
+			out_file = os.path.splitext(os.path.basename(in_file))[0] + ".fdb"
+
+		self.sqlite = sqlite3.connect(in_file)
+		self.fdb = open(out_file, "wb")
+		self.strings = {} # deduplicate identical strings, value: pointer
+		self.int64s = {}
+
+		self._write()
+		print("-"*79)
+		print("Finished converting database!")
+		print("Converted file is at: "+out_file)
+		print("-"*79)
+
+		self.fdb.close()
+		self.sqlite.close()
+
+	def _write(self):
+		tables = [row[0] for row in self.sqlite.execute("select name from sqlite_master where type == 'table' and name not like 'sqlite_%' order by rowid")]
+		# header and table array, the table array is filled in at the end
+		self.fdb.write(INT32_PAIR.pack(len(tables), 8))
+		self.fdb.write(bytes(8*len(tables)))
+		self.pos = 8+8*len(tables)
+
+		table_pointers = []
+		for table_index, table_name in enumerate(tables):
+			print("[%2i%%] Writing table %s" % (table_index*100//len(tables), table_name))
+			self.buffer = bytearray()
+			table_pointers.append(self._write_table(table_name))
+			self.fdb.write(self.buffer)
+			self.pos += len(self.buffer)
+
+		self.fdb.seek(8)
+		self.fdb.write(b"".join(INT32_PAIR.pack(*pointers) for pointers in table_pointers))
+
+	def _put(self, data):
+		"""Append data to the output, returning its pointer."""
+		pointer = self.pos + len(self.buffer)
+		self.buffer += data
+		return pointer
+
+	def _put_string(self, str_):
+		if str_ not in self.strings:
+			self.strings[str_] = self._put(str_.encode("latin1")+b"\0")
+		return self.strings[str_]
+
+	def _put_int64(self, value):
+		if value not in self.int64s:
+			self.int64s[value] = self._put(INT64.pack(value))
+		return self.int64s[value]
+
+	def _write_table(self, table_name):
+		columns = [(name, type_) for _, name, type_, _, _, _ in self.sqlite.execute("pragma table_info('%s')" % table_name)]
+		has_link_info = [name for name, _ in columns[-3:]] == LINK_INFO_COLUMNS
+		if has_link_info:
+			columns = columns[:-3]
+		data_types = [self._data_type(table_name, name, type_) for name, type_ in columns]
+
+		column_array = b"".join(INT32_PAIR.pack(data_type, self._put_string(name)) for (name, _), data_type in zip(columns, data_types))
+		column_header = self._put(struct.pack("<iii", len(columns), self._put_string(table_name), self._put(column_array)))
+
+		buckets = None
+		if has_link_info:
+			buckets = self._linked_buckets(table_name)
+		if buckets is None:
+			buckets = self._hashed_buckets(table_name, has_link_info)
+
+		bucket_pointers = []
+		for chain in buckets:
+			row_infos = [self._put(INT32_PAIR.pack(len(data_types), self._put(self._row_values(data_types, row)))) for row in chain]
+			node = -1
+			for row_info in reversed(row_infos):
+				node = self._put(INT32_PAIR.pack(row_info, node))
+			bucket_pointers.append(node)
+
+		# fdb_to_sqlite reads the bucket array from the position after the row header, so it has to follow it directly
+		row_header = self._put(struct.pack("<ii%ii" % len(buckets), len(buckets), self.pos+len(self.buffer)+8, *bucket_pointers))
+		return column_header, row_header
+
+	def _data_type(self, table_name, column, declared_type):
+		"""
+		FDB type of a column. Declared types that aren't FDB types are mapped by SQLite's type affinity rules (so e.g. varchar(20) is text), columns without a type affinity (untyped, blob, numeric) by the values stored in them.
+		Integer columns are int64 if their values don't fit into int32, like object IDs.
+		Raises:
+			ValueError if the values don't fit any FDB type.
+		"""
+		declared_type = declared_type.lower()
+		if declared_type in FDB_TYPE:
+			if FDB_TYPE[declared_type] == FDB_TYPE["int"]:
+				return self._int_type(table_name, column, declared_type)
+			return FDB_TYPE[declared_type]
+		if "int" in declared_type:
+			return self._int_type(table_name, column, declared_type)
+		if "char" in declared_type or "clob" in declared_type or "text" in declared_type:
+			return FDB_TYPE["text"]
+		if "real" in declared_type or "floa" in declared_type or "doub" in declared_type:
+			return FDB_TYPE["real"]
+		value_types = {row[0] for row in self.sqlite.execute("select distinct typeof(\"%s\") from '%s'" % (column, table_name))}
+		value_types.discard("null")
+		if not value_types:
+			return FDB_TYPE["none"]
+		if value_types == {"integer"}:
+			return self._int_type(table_name, column, declared_type)
+		if value_types <= {"integer", "real"}:
+			return FDB_TYPE["real"]
+		if value_types == {"text"}:
+			return FDB_TYPE["text"]
+		raise ValueError("Column %s of table %s (declared type \"%s\") has values of types %s, which don't fit a FDB type. Declare it as one of %s." % (column, table_name, declared_type, ", ".join(sorted(value_types)), ", ".join(sorted(FDB_TYPE))))
+
+	def _int_type(self, table_name, column, declared_type):
+		"""
+		int32, or int64 if the column has values outside of the int32 range.
+		Raises:
+			ValueError if the column is explicitly declared as int32 but has values outside of its range.
+		"""
+		min_value, max_value = self.sqlite.execute("select min(\"%s\"), max(\"%s\") from '%s' where typeof(\"%s\") == 'integer'" % (column, column, table_name, column)).fetchone()
+		if min_value is None or INT32_MIN <= min_value and max_value <= INT32_MAX:
+			return FDB_TYPE["int"]
+		if declared_type == SQLITE_TYPE[FDB_TYPE["int"]]:
+			raise ValueError("Column %s of table %s is declared as %s, but has values from %i to %i, which don't fit into it. Declare it as %s." % (column, table_name, declared_type, min_value, max_value, SQLITE_TYPE[FDB_TYPE["int64"]]))
+		return FDB_TYPE["int64"]
+
+	def _linked_buckets(self, table_name):
+		"""
+		Rebuild the original bucket layout from the link info columns. Returns None if the link info is inconsistent, e.g. after rows were added without it.
+		Rows whose key was changed so that it no longer hashes to their bucket are moved to the end of the right one, otherwise the client couldn't find them.
+		"""
+		buckets = []
+		bucket_of_row = {}
+		for row in self.sqlite.execute("select rowid, * from '%s' order by rowid" % table_name):
+			rowid, values, (linked_from, _, invalid) = row[0], row[1:-3], row[-3:]
+			if invalid:
+				buckets.append([])
+			elif linked_from is None:
+				bucket_of_row[rowid] = len(buckets)
+				buckets.append([values])
+			elif linked_from in bucket_of_row:
+				bucket = bucket_of_row[linked_from]
+				bucket_of_row[rowid] = bucket
+				buckets[bucket].append(values)
+			else:
+				return None
+		if buckets and len(buckets) & (len(buckets) - 1) != 0:
+			return None
+		moved = []
+		for bucket, chain in enumerate(buckets):
+			if any(key_hash(values[0]) % len(buckets) != bucket for values in chain):
+				moved.extend(values for values in chain if key_hash(values[0]) % len(buckets) != bucket)
+				chain[:] = [values for values in chain if key_hash(values[0]) % len(buckets) == bucket]
+		for values in moved:
+			buckets[key_hash(values[0]) % len(buckets)].append(values)
+		return buckets
+
+	def _hashed_buckets(self, table_name, has_link_info):
+		rows = self.sqlite.execute("select * from '%s' order by rowid" % table_name).fetchall()
+		if has_link_info:
+			rows = [row[:-3] for row in rows if not row[-1]]
+		if not rows:
+			return []
+		number_of_buckets = 1 << (len(rows)-1).bit_length()
+		buckets = [[] for _ in range(number_of_buckets)]
+		for row in rows:
+			buckets[key_hash(row[0]) % number_of_buckets].append(row)
+		return buckets
+
+	def _row_values(self, data_types, row):
+		values = bytearray()
+		for data_type, value in zip(data_types, row):
+			if value is None or data_type == 0:
+				values += INT32_PAIR.pack(0, 0)
+			elif data_type == 1:
+				values += INT32_PAIR.pack(1, int(value))
+			elif data_type == 3:
+				values += INT32_FLOAT.pack(3, float(value))
+			elif data_type in (4, 8):
+				values += INT32_PAIR.pack(data_type, self._put_string(str(value)))
+			elif data_type == 5:
+				values += INT32_BOOL.pack(5, bool(value))
+			elif data_type == 6:
+				values += INT32_PAIR.pack(6, self._put_int64(int(value)))
+			else:
+				raise NotImplementedError(data_type)
+		return values
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("sqlite_path")
+	parser.add_argument("--fdb_path")
+	args = parser.parse_args()
+	convert(args.sqlite_path, args.fdb_path)
@@ -2,10 +2,13 @@
 Module for parsing binary data into structs.
 """
 import argparse
+import os.path
 import re
+import time
 from collections import namedtuple
+from collections.abc import Mapping
 
-from bitstream import c_bit, c_float, c_double, c_int8, c_uint8, c_int16, c_uint16, c_int32, c_uint32, c_int64, c_uint64, ReadStream
+from bitstream import c_bit, c_float, c_double, c_int8, c_uint8, c_int16, c_uint16, c_int32, c_uint32, c_int64, c_uint64, ReadStream, WriteStream
 
 VAR_CHARS = r"[^ \t\[\]]+"
 
@@ -34,6 +37,92 @@ StructDefinition = namedtuple("struct_token", ("var_assign", "type", "descriptio
 
 Structure = namedtuple("Structure", ("level", "description", "value", "unexpected"))
 
+SERIALIZE_TYPES = {}
+SERIALIZE_TYPES["bit"] = c_bit
+SERIALIZE_TYPES["float"] = c_float
+SERIALIZE_TYPES["double"] = c_double
+SERIALIZE_TYPES["s8"] = c_int8
+SERIALIZE_TYPES["u8"] = c_uint8
+SERIALIZE_TYPES["s16"] = c_int16
+SERIALIZE_TYPES["u16"] = c_uint16
+SERIALIZE_TYPES["s32"] = c_int32
+SERIALIZE_TYPES["u32"] = c_uint32
+SERIALIZE_TYPES["s64"] = c_int64
+SERIALIZE_TYPES["u64"] = c_uint64
+# string types, with their length type
+SERIALIZE_STRING_TYPES = {}
+SERIALIZE_STRING_TYPES["u8-string"] = c_uint8
+SERIALIZE_STRING_TYPES["u16-string"] = c_uint16
+SERIALIZE_STRING_TYPES["u8-wstring"] = c_uint8
+SERIALIZE_STRING_TYPES["u16-wstring"] = c_uint16
+
+# values used for structures missing from a values dict, 0 for all other types
+DEFAULT_VALUES = {}
+DEFAULT_VALUES["bit"] = False
+DEFAULT_VALUES["float"] = 0.0
+DEFAULT_VALUES["double"] = 0.0
+DEFAULT_VALUES["u8-string"] = b""
+DEFAULT_VALUES["u16-string"] = b""
+DEFAULT_VALUES["u8-wstring"] = ""
+DEFAULT_VALUES["u16-wstring"] = ""
+
+class LineProfile:
+	"""Profiling counters of one definition line. Times are in seconds and include the lines nested under this one, except for eval_time."""
+	__slots__ = "lineno", "text", "calls", "time", "bits", "eval_count", "eval_time", "expect_failures", "assert_failures"
+
+	def __init__(self, lineno, text):
+		self.lineno = lineno
+		self.text = text
+		self.calls = 0
+		self.time = 0
+		self.bits = 0
+		self.eval_count = 0
+		self.eval_time = 0
+		self.expect_failures = 0
+		self.assert_failures = 0
+
+class ParserProfile:
+	"""
+	Profiling results of a StructParser, see StructParser.enable_profiling.
+	Time spent by the consumer of the parse generator is not counted.
+	Attributes:
+		name: Name of the parser, used in the exports.
+		lines: LineProfile for each definition line, in definition order.
+		stacks: Exclusive time in seconds for each stack of nested definition lines (tuples of LineProfile).
+	"""
+	def __init__(self, name, lines):
+		self.name = name
+		self.lines = lines
+		self.stacks = {}
+		self._stack = []
+		self._paused = 0
+		self._pause_start = 0
+
+	def _clock(self):
+		return time.perf_counter() - self._paused
+
+	def _pause(self):
+		self._pause_start = time.perf_counter()
+
+	def _resume(self):
+		self._paused += time.perf_counter() - self._pause_start
+
+def format_profiles(profiles, sort_by="time"):
+	"""Format the line counters of ParserProfiles as a table, sorted descending by a LineProfile attribute."""
+	rows = [(profile.name, line) for profile in profiles for line in profile.lines if line.calls]
+	rows.sort(key=lambda row: getattr(row[1], sort_by), reverse=True)
+	out = "%-24s %5s %9s %10s %10s %7s %9s %7s %7s  %s\n" % ("parser", "line", "calls", "time (ms)", "bits", "evals", "eval (ms)", "expect", "assert", "definition")
+	for name, line in rows:
+		out += "%-24s %5i %9i %10.3f %10i %7i %9.3f %7i %7i  %s\n" % (name, line.lineno, line.calls, line.time*1000, line.bits, line.eval_count, line.eval_time*1000, line.expect_failures, line.assert_failures, line.text)
+	return out
+
+def write_collapsed_stacks(profiles, file):
+	"""Write the stacks of ParserProfiles in the collapsed stack format of flamegraph.pl (one "frame;frame;frame count" line per stack), with the count in microseconds."""
+	for profile in profiles:
+		for stack, self_time in profile.stacks.items():
+			frames = [profile.name]+["%i: %s" % (line.lineno, line.text) for line in stack]
+			file.write(";".join(frame.replace(";", ",") for frame in frames)+" %i\n" % round(self_time*1000000))
+
 class StructParser:
 	def __init__(self, struct_defs, type_handlers={}):
 		"""
@@ -43,8 +132,11 @@ class StructParser:
 			type_handlers: Parsing handlers for custom types, provided as {"type": handler_func}.
 		"""
 		self._variables = {}
+		self._def_lines = {}
+		self.profile = None
 		struct_defs = struct_defs.splitlines()
-		struct_defs = [re.search(DEFINITION_SYNTAX, struct).groupdict() for struct in struct_defs if re.search(DEFINITION_SYNTAX, struct) is not None] # Filter out lines not matching the syntax
+		struct_defs = [(lineno, re.search(DEFINITION_SYNTAX, struct)) for lineno, struct in enumerate(struct_defs, 1)]
+		struct_defs = [dict(match.groupdict(), lineno=lineno, text=match.group().strip()) for lineno, match in struct_defs if match is not None] # Filter out lines not matching the syntax
 
 		self.defs = self._to_tree(iter(struct_defs))[0]
 
@@ -94,6 +186,30 @@ class StructParser:
 			stream = ReadStream(data)
 		yield from self._parse_struct_occurrences(stream, self.defs)
 
+	def enable_profiling(self, name="parser"):
+		"""
+		Start recording per definition line counters and timings for all following parses.
+		Parsing with profiling disabled has no overhead, the instrumented parse code is only used while profiling is enabled.
+		Arguments:
+			name: Name of this parser in the exports.
+		Returns:
+			The ParserProfile the results are recorded in, also available as the profile attribute.
+		"""
+		lines = {def_id: LineProfile(lineno, text) for def_id, (lineno, text) in self._def_lines.items()}
+		self.profile = ParserProfile(name, sorted(lines.values(), key=lambda line: line.lineno))
+		self._line_profiles = lines
+		self._parse_struct_occurrences = self._profiled_parse_struct_occurrences
+		self._eval = self._profiled_eval
+		return self.profile
+
+	def disable_profiling(self):
+		"""Stop profiling. The last profile stays available as the profile attribute. Does nothing if profiling isn't enabled."""
+		if not hasattr(self, "_line_profiles"):
+			return
+		del self._parse_struct_occurrences
+		del self._eval
+		del self._line_profiles
+
 	def _to_tree(self, def_iter, stack_level=0, start_def=None):
 		current_level = []
 		try:
@@ -105,6 +221,7 @@ class StructParser:
 			while True:
 				if len(def_["indent"]) == stack_level:
 					def_tuple = self._to_def_tuple(def_)
+					self._def_lines[id(def_tuple)] = def_["lineno"], def_["text"]
 					current_level.append((def_tuple, ()))
 					def_ = next(def_iter)
 				elif len(def_["indent"]) == stack_level+1:
@@ -190,18 +307,209 @@ class StructParser:
 		globals_.update(self._variables)
 		return eval(expression, globals_) # definitely not safe, fwiw
 
+	# Instrumented versions of the above, swapped in by enable_profiling. Keep the parsing logic in sync with the uninstrumented ones.
+
+	def _profiled_parse_struct_occurrences(self, stream, defs, stack_level=0, repeat_times=1):
+		profile = self.profile
+		for _ in range(repeat_times):
+			for def_, children in defs:
+				line = self._line_profiles[id(def_)]
+				line.calls += 1
+				start_bits = stream.read_offset
+				start = profile._clock()
+				profile._stack.append(line)
+				try:
+					if isinstance(def_, IfStatement):
+						if children and self._eval(def_.condition):
+							break_ = yield from self._profiled_parse_struct_occurrences(stream, children, stack_level+1)
+							if break_:
+								return True
+					elif isinstance(def_, WhileStatement):
+						if children:
+							while self._eval(def_.condition):
+								break_ = yield from self._profiled_parse_struct_occurrences(stream, children, stack_level+1)
+								if break_:
+									break
+					elif isinstance(def_, BreakStatement):
+						return True
+					else:
+						value = self._type_handlers[def_.type](stream)
+
+						if def_.expects:
+							for expression in def_.expects:
+								if not self._eval(expression, value):
+									unexpected = True
+									line.expect_failures += 1
+									break
+							else:
+								unexpected = False
+						else:
+							unexpected = None
+
+						for expression in def_.asserts:
+							if not self._eval(expression, value):
+								line.assert_failures += 1
+								raise AssertionError((value, expression, def_))
+
+						if def_.var_assign is not None:
+							self._variables[def_.var_assign] = value
+						profile._pause()
+						yield Structure(stack_level, def_.description, value, unexpected)
+						profile._resume()
+
+						if children and value:
+							break_ = yield from self._profiled_parse_struct_occurrences(stream, children, stack_level+1, value)
+							if break_:
+								return True
+				finally:
+					elapsed = profile._clock() - start
+					line.time += elapsed
+					line.bits += stream.read_offset - start_bits
+					stack = tuple(profile._stack)
+					profile.stacks[stack] = profile.stacks.get(stack, 0) + elapsed
+					profile._stack.pop()
+					if profile._stack:
+						# the parent's exclusive time doesn't include this
+						parent_stack = tuple(profile._stack)
+						profile.stacks[parent_stack] = profile.stacks.get(parent_stack, 0) - elapsed
+
+	def _profiled_eval(self, expression, value=None):
+		line = self.profile._stack[-1]
+		line.eval_count += 1
+		start = self.profile._clock()
+		try:
+			return StructParser._eval(self, expression, value)
+		finally:
+			line.eval_time += self.profile._clock() - start
+
+class _Break(Exception):
+	pass
+
+class StructSerializer:
+	def __init__(self, struct_defs, type_writers={}):
+		"""
+		Compile the structure definitions into a function writing them to a bitstream, the counterpart of StructParser.
+		if, while and break statements and repeating nested structures (e.g. behind flag bits) work the same way as when parsing, except that expects and asserts aren't checked.
+		Arguments:
+			struct_defs: A string of structure definitions in the same format as for StructParser.
+			type_writers: Serialization handlers for custom types, provided as {"type": writer_func(stream, value)}.
+		Raises:
+			ValueError if a type has no writer.
+		"""
+		self._type_writers = type_writers
+		self._namespace = {"_Break": _Break}
+		code = ["def serialize(stream, next_value, variables):", "\ttry:"]
+		self._compile(StructParser(struct_defs).defs, code, 2)
+		code += ["\texcept _Break:", "\t\tpass"]
+		self.source = "\n".join(code)
+		exec(compile(self.source, "<struct serializer>", "exec"), self._namespace)
+		self._serialize = self._namespace["serialize"]
+
+	def serialize(self, values, variables=None):
+		"""
+		Serialize the values, returning the bytes. See serialize_to for the arguments.
+		"""
+		stream = WriteStream()
+		self.serialize_to(stream, values, variables)
+		return bytes(stream)
+
+	def serialize_to(self, stream, values, variables=None):
+		"""
+		Serialize the values to a WriteStream.
+
+		Arguments:
+			stream: The WriteStream to write to.
+			values: The values of the structures, as one of
+				a sequence of values in the order StructParser.parse yields them (e.g. [structure.value for structure in parser.parse(data)]),
+				a dict mapping the variable name if the definition assigns one, else the description, to the value (missing values default to 0, False or empty strings),
+				a function (key, type) -> value, with key like for a dict and type the type from the definition, for generating values on the fly.
+			variables: A dict of variables to be used in conditions, like for StructParser.parse.
+		Raises:
+			ValueError if a sequence has too few or too many values.
+		"""
+		globals_ = {"__builtins__": {}, "value": None}
+		if variables is not None:
+			globals_.update(variables)
+		iterator = None
+		if callable(values):
+			next_value = values
+		elif isinstance(values, Mapping):
+			next_value = lambda key, type_: values[key] if key in values else DEFAULT_VALUES.get(type_, 0)
+		else:
+			iterator = iter(values)
+			next_value = lambda key, type_: next(iterator)
+		try:
+			self._serialize(stream, next_value, globals_)
+		except StopIteration:
+			raise ValueError("Not enough values for the structure definitions") from None
+		if iterator is not None and next(iterator, _Break) is not _Break:
+			raise ValueError("More values than structures in the definitions")
+
+	def _constant(self, value):
+		name = "_c%i" % len(self._namespace)
+		self._namespace[name] = value
+		return name
+
+	def _compile(self, defs, code, level):
+		indent = "\t"*level
+		start = len(code)
+		for def_, children in defs:
+			if isinstance(def_, IfStatement):
+				if children:
+					code.append(indent+"if eval(%s, variables):" % self._constant(def_.condition))
+					self._compile(children, code, level+1)
+			elif isinstance(def_, WhileStatement):
+				if children:
+					code.append(indent+"while eval(%s, variables):" % self._constant(def_.condition))
+					code.append(indent+"\ttry:")
+					self._compile(children, code, level+2)
+					code.append(indent+"\texcept _Break:")
+					code.append(indent+"\t\tbreak")
+			elif isinstance(def_, BreakStatement):
+				code.append(indent+"raise _Break") # breaks out of the innermost while, like returning True from _parse_struct_occurrences
+			else:
+				if def_.var_assign is not None:
+					key = def_.var_assign
+				else:
+					key = def_.description
+				code.append(indent+"value = next_value(%r, %r)" % (key, def_.type))
+				if def_.type in self._type_writers:
+					code.append(indent+"%s(stream, value)" % self._constant(self._type_writers[def_.type]))
+				elif def_.type in SERIALIZE_TYPES:
+					code.append(indent+"stream.write(%s(value))" % self._constant(SERIALIZE_TYPES[def_.type]))
+				elif def_.type in SERIALIZE_STRING_TYPES:
+					code.append(indent+"stream.write(value, length_type=%s)" % self._constant(SERIALIZE_STRING_TYPES[def_.type]))
+				else:
+					raise ValueError("No writer for type "+def_.type)
+				if def_.var_assign is not None:
+					code.append(indent+"variables[%r] = value" % def_.var_assign)
+				if children:
+					code.append(indent+"for _ in range(value):")
+					self._compile(children, code, level+1)
+		if len(code) == start:
+			code.append(indent+"pass")
 
 if __name__ == "__main__":
 	argparser = argparse.ArgumentParser(description=__doc__)
 	argparser.add_argument("filepath", help="path of binary file")
 	argparser.add_argument("definition", help="struct definition file path to parse with")
+	argparser.add_argument("--profile", action="store_true", help="print per definition line timings and counters")
+	argparser.add_argument("--flamegraph", help="write profiling stacks to this path, in the collapsed stack format of flamegraph.pl")
 	args = argparser.parse_args()
 
 	with open(args.definition) as file:
 		defs = file.read()
 
 	parser = StructParser(defs)
+	if args.profile or args.flamegraph is not None:
+		parser.enable_profiling(os.path.basename(args.definition))
 
 	with open(args.filepath, "rb") as file:
 		for structure in parser.parse(file.read()):
 			print(structure)
+
+	if args.profile:
+		print(format_profiles([parser.profile]))
+	if args.flamegraph is not None:
+		with open(args.flamegraph, "w") as file:
+			write_collapsed_stacks([parser.profile], file)
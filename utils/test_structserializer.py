@@ -0,0 +1,44 @@
+"""
+Round trip check of StructSerializer against StructParser on the replica definitions.
+Random values are serialized, parsed back and serialized again, which has to give the same bytes.
+Run with python -m unittest test_structserializer (or pytest) in this directory.
+"""
+import glob
+import os.path
+import random
+import unittest
+
+import replicavalues
+from bitstream import ReadStream
+from structparser import StructParser, StructSerializer
+
+REPLICA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "packetdefinitions", "replica")
+CASES = 30
+
+class ReplicaRoundTripTest(unittest.TestCase):
+	def test_replica_definitions(self):
+		paths = [os.path.join(REPLICA_DIR, "creation_header.structs"), os.path.join(REPLICA_DIR, "serialization_header.structs")]
+		paths += sorted(glob.glob(os.path.join(REPLICA_DIR, "components", "*.structs")))
+		for path in paths:
+			with open(path, encoding="utf-8") as file:
+				definition = file.read()
+			parser = StructParser(definition, replicavalues.TYPE_HANDLERS)
+			serializer = StructSerializer(definition, replicavalues.TYPE_WRITERS)
+			for creation in (True, False):
+				with self.subTest(definition=os.path.relpath(path, REPLICA_DIR), creation=creation):
+					rng = random.Random(0)
+					checked = 0
+					for _ in range(CASES):
+						data = serializer.serialize(replicavalues.random_values(rng, replicavalues.CREATION_HEADER_VALUES), {"creation": creation})
+						stream = ReadStream(data)
+						try:
+							values = [structure.value for structure in parser.parse(stream, {"creation": creation})]
+						except AssertionError: # random values can fail the definition's asserts
+							continue
+						self.assertTrue(stream.all_read())
+						self.assertEqual(serializer.serialize(values, {"creation": creation}), data)
+						checked += 1
+					self.assertGreater(checked, 0)
+
+if __name__ == "__main__":
+	unittest.main()
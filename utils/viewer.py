@@ -133,6 +133,9 @@ class Viewer(Frame):
 		if query:
 			self._filter_items(query)
 
+	def _item_matches(self, item, query) -> bool:
+		return any(query in i.lower() for i in self.tree.item(item, "values")) or query in self.tree.item(item, "text").lower()
+
 	def _reattach_all(self) -> None:
 		for parent, detached_children in self.detached_items.items():
 			for index, item in detached_children:
@@ -141,7 +144,7 @@ class Viewer(Frame):
 
 	def _filter_items(self, query, parent=""):
 		all_children = self.tree.get_children(parent)
-		detached_children = [item for item in all_children if not any(query in i.lower() for i in self.tree.item(item, "values")) and not query in self.tree.item(item, "text").lower()] # first, find all children that don't match
+		detached_children = [item for item in all_children if not self._item_matches(item, query)] # first, find all children that don't match
 		for item in all_children:
 			if item not in detached_children:
 				tags = list(self.tree.item(item, "tags"))
@@ -0,0 +1,100 @@
+"""Module for reading the members of a zip file (like a capture) without copying their data around more than necessary."""
+import mmap
+import struct
+import zipfile
+import zlib
+
+# signature, (version, flags, compression, time, date, crc, sizes), name length, extra field length
+LOCAL_HEADER = struct.Struct("<4s22xHH")
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+def as_bytes(view):
+	"""Bytes of a view returned by ZipMembers.view (or of bytes), for consumers that need bytes, like ReadStream. Doesn't copy if the view covers a whole bytes object, like a decompressed member."""
+	if isinstance(view, bytes):
+		return view
+	if isinstance(view.obj, bytes) and view.nbytes == len(view.obj):
+		return view.obj
+	return bytes(view)
+
+class ZipMembers:
+	"""
+	Read access to the members of a zip file.
+	The file is mapped into memory, stored (uncompressed) members are read directly from the map, so view() doesn't copy them at all. Compressed members are decompressed into one buffer each.
+	Unlike zipfile, the CRCs of stored members aren't checked.
+	Views returned by view() have to be released (or garbage collected) before close() can unmap the file.
+	"""
+	def __init__(self, path):
+		self.zip = zipfile.ZipFile(path)
+		self._file = open(self.zip.filename, "rb")
+		try:
+			self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError: # empty file
+			self._map = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.close()
+
+	@property
+	def filename(self):
+		return self.zip.filename
+
+	def close(self):
+		self.zip.close()
+		if self._map is not None:
+			try:
+				self._map.close()
+			except BufferError:
+				pass # views are still in use, the map is closed once they're gone
+			self._map = None
+		self._file.close()
+
+	def namelist(self):
+		return self.zip.namelist()
+
+	def _data_offset(self, info):
+		"""Offset of the member's (possibly compressed) data in the file if it can be read directly from the map, else None."""
+		if self._map is None or info.flag_bits & 1: # encrypted
+			return None
+		signature, name_length, extra_length = LOCAL_HEADER.unpack_from(self._map, info.header_offset)
+		if signature != LOCAL_HEADER_SIGNATURE:
+			raise zipfile.BadZipFile("Bad magic number for file header of "+info.filename)
+		# the local extra field can differ from the one in the central directory
+		return info.header_offset + LOCAL_HEADER.size + name_length + extra_length
+
+	def view(self, name):
+		"""The member's data as memoryview. Slicing it doesn't copy."""
+		info = self.zip.getinfo(name)
+		offset = self._data_offset(info)
+		if offset is None or info.compress_type != zipfile.ZIP_STORED:
+			return memoryview(self.zip.read(info))
+		return memoryview(self._map)[offset:offset+info.file_size]
+
+	def read(self, name):
+		"""The member's data as bytes, for consumers that need bytes, like ReadStream. Only copies stored members, once."""
+		info = self.zip.getinfo(name)
+		offset = self._data_offset(info)
+		if offset is None or info.compress_type != zipfile.ZIP_STORED:
+			return self.zip.read(info)
+		return self._map[offset:offset+info.file_size]
+
+	def read_raw(self, name):
+		"""
+		The member's data as it is stored in the file, so that reading and decompressing it can be timed separately.
+		Returns:
+			A tuple (data, compression method) to pass to decompress. Members that can't be read raw (encrypted ones and ones compressed with other methods than deflate) are returned decompressed, as ZIP_STORED.
+		"""
+		info = self.zip.getinfo(name)
+		offset = self._data_offset(info)
+		if offset is None or info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+			return self.zip.read(info), zipfile.ZIP_STORED
+		return self._map[offset:offset+info.compress_size], info.compress_type
+
+	@staticmethod
+	def decompress(data, compress_type):
+		"""Decompress data returned by read_raw."""
+		if compress_type == zipfile.ZIP_DEFLATED:
+			return zlib.decompress(data, -zlib.MAX_WBITS)
+		return data